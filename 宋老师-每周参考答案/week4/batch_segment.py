@@ -0,0 +1,87 @@
+#coding: utf-8
+
+"""
+大规模语料的批量分词
+输入文件（或任意行迭代器）被切成小块分发到多个进程，每个进程只在启动时加载一次词典
+结果按输入顺序写入输出文件，每行词之间用空格分开，并统计每秒处理的行数
+用法：python batch_segment.py input.txt output.txt --dict dict.txt --workers 8
+"""
+
+import sys
+import time
+import argparse
+from multiprocessing import Pool, cpu_count
+from dict_trie import DictTrie
+from compiled_dict import CompiledDict, COMPILED_SUFFIX
+from hmm import HMMSegmenter
+from week4_answer import DAGBestDecode, dict_trie
+
+#每个子进程持有的词典，由init_worker在进程启动时加载
+worker_trie = None
+worker_hmm = None
+
+
+def load_trie(dict_path=None):
+    if dict_path is None:
+        return dict_trie
+    #编译后的词典直接mmap打开，各进程共享同一份只读页面
+    if dict_path.endswith(COMPILED_SUFFIX):
+        return CompiledDict(dict_path)
+    return DictTrie.from_file(dict_path)
+
+
+def init_worker(dict_path, use_hmm=False):
+    global worker_trie, worker_hmm
+    worker_trie = load_trie(dict_path)
+    worker_hmm = HMMSegmenter.from_jieba() if use_hmm else None
+
+
+def segment_line(line):
+    sentence = line.rstrip("\n")
+    if not sentence:
+        return ""
+    return " ".join(DAGBestDecode(sentence, worker_trie, worker_hmm).decode())
+
+
+#lines可以是文件对象，也可以是任意产出字符串的迭代器
+#imap保证输出顺序与输入一致，chunksize控制每次发给子进程的行数，减少进程间通信次数
+def segment_lines(lines, dict_path=None, workers=None, chunksize=1000, use_hmm=False):
+    workers = workers or cpu_count()
+    if workers == 1:
+        init_worker(dict_path, use_hmm)
+        for line in lines:
+            yield segment_line(line)
+        return
+    with Pool(workers, initializer=init_worker, initargs=(dict_path, use_hmm)) as pool:
+        for result in pool.imap(segment_line, lines, chunksize=chunksize):
+            yield result
+
+
+def segment_file(input_path, output_path, dict_path=None, workers=None, chunksize=1000, use_hmm=False, log_every=100000):
+    start_time = time.time()
+    line_count = 0
+    with open(input_path, encoding="utf8") as fin, open(output_path, "w", encoding="utf8") as fout:
+        for result in segment_lines(fin, dict_path, workers, chunksize, use_hmm):
+            fout.write(result + "\n")
+            line_count += 1
+            if log_every and line_count % log_every == 0:
+                print("已处理%d行，速度%.1f行/秒" % (line_count, line_count / (time.time() - start_time)))
+    cost = time.time() - start_time
+    print("共处理%d行，耗时%.2f秒，速度%.1f行/秒" % (line_count, cost, line_count / max(cost, 1e-9)))
+    return line_count, cost
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量分词")
+    parser.add_argument("input", help="输入文件，每行一个句子")
+    parser.add_argument("output", help="输出文件，每行为空格分开的分词结果")
+    parser.add_argument("--dict", default=None, help="jieba格式词频文件或编译后的.w4dict词典，不指定时使用week4_answer中的Dict")
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认使用全部cpu")
+    parser.add_argument("--chunksize", type=int, default=1000, help="每次分发给子进程的行数")
+    parser.add_argument("--hmm", action="store_true", help="对连续的未登录单字使用HMM切分")
+    args = parser.parse_args(argv)
+    segment_file(args.input, args.output, args.dict, args.workers, args.chunksize, args.hmm)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,120 @@
+#coding: utf-8
+
+"""
+week4分词算法的性能测试
+用Dict中的词随机拼接出不同长度的句子，分别统计calc_dag、全切分DAGDecode.decode以及新增解码方法的
+每秒处理字数、峰值内存，并用对数坐标下的线性拟合估计耗时随句长增长的阶数（1附近为线性，2附近为平方）
+结果保存为json，便于不同版本之间对比
+用法：python benchmark.py --lengths 10 20 40 80 --output benchmark.json
+"""
+
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+from week4_answer import Dict, dict_trie, calc_dag, DAGDecode, DAGBestDecode, iter_segmentations, count_segmentations
+
+
+#用词典中的词随机拼接出长度恰好为length的句子
+def make_sentence(length, rng):
+    words = list(Dict)
+    sentence = ""
+    while len(sentence) < length:
+        sentence += rng.choice(words)
+    return sentence[:length]
+
+
+def run_dag_decode(sentence):
+    dd = DAGDecode(sentence)
+    dd.decode()
+    return dd.finish_path
+
+
+#被测的各个算法，值为只接收句子的函数
+ALGORITHMS = {
+    "calc_dag": lambda sentence: calc_dag(sentence),
+    "DAGDecode.decode": run_dag_decode,
+    "DAGBestDecode.decode": lambda sentence: DAGBestDecode(sentence).decode(),
+    "DAGBestDecode.decode_topk5": lambda sentence: DAGBestDecode(sentence).decode_topk(5),
+    "iter_segmentations_limit1000": lambda sentence: list(iter_segmentations(sentence, limit=1000)),
+    "count_segmentations": lambda sentence: count_segmentations(sentence),
+}
+
+#全切分的耗时和内存随切分数量指数增长，切分数超过该值的句子不再测试全切分
+MAX_ENUMERATE = 200000
+
+
+#返回(平均耗时秒数, 峰值内存字节数)
+def measure(func, sentence, repeat):
+    tracemalloc.start()
+    func(sentence)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        func(sentence)
+    return (time.perf_counter() - start_time) / repeat, peak
+
+
+#log(耗时) = a * log(句长) + b，a即为增长阶数
+def growth_order(lengths, seconds):
+    if len(lengths) < 2:
+        return None
+    return float(np.polyfit(np.log(lengths), np.log(seconds), 1)[0])
+
+
+def run_benchmark(lengths, repeat=5, seed=42, max_enumerate=MAX_ENUMERATE, algorithms=None):
+    rng = random.Random(seed)
+    sentences = dict((length, make_sentence(length, rng)) for length in lengths)
+    results = {}
+    for name in algorithms or ALGORITHMS:
+        func = ALGORITHMS[name]
+        rows = []
+        for length in lengths:
+            sentence = sentences[length]
+            num_segmentations = count_segmentations(sentence)
+            if name == "DAGDecode.decode" and num_segmentations > max_enumerate:
+                print("%s 句长%d 切分数%d，跳过" % (name, length, num_segmentations))
+                continue
+            seconds, peak = measure(func, sentence, repeat)
+            rows.append({"length": length,
+                         "num_segmentations": num_segmentations,
+                         "seconds": seconds,
+                         "chars_per_sec": length / seconds,
+                         "peak_memory_bytes": peak})
+            print("%-30s 句长%-6d %12.1f字/秒  峰值内存%10d字节" % (name, length, length / seconds, peak))
+        results[name] = {"runs": rows,
+                         "growth_order": growth_order([row["length"] for row in rows], [row["seconds"] for row in rows])}
+    return {"meta": {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                     "python": platform.python_version(),
+                     "platform": platform.platform(),
+                     "dict_size": len(dict_trie),
+                     "repeat": repeat,
+                     "seed": seed},
+            "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="week4分词算法性能测试")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 20, 40, 80, 160, 320, 640])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--max-enumerate", type=int, default=MAX_ENUMERATE)
+    parser.add_argument("--algorithms", nargs="+", default=None, choices=list(ALGORITHMS))
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args(argv)
+    report = run_benchmark(args.lengths, args.repeat, args.seed, args.max_enumerate, args.algorithms)
+    for name, result in report["results"].items():
+        if result["growth_order"] is not None:
+            print("%-30s 耗时增长阶数约为%.2f" % (name, result["growth_order"]))
+    with open(args.output, "w", encoding="utf8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print("结果已保存至", args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
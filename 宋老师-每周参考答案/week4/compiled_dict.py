@@ -0,0 +1,158 @@
+#coding: utf-8
+
+"""
+编译后的词频词典，可直接内存映射（mmap）打开
+几十万词的词典用python字典加载需要数秒、占用数百MB，且每个进程各存一份
+这里把前缀树预先编译成一个二进制文件，打开时只做mmap，不解析任何内容，毫秒级完成；多个进程打开同一文件时共享操作系统的页缓存
+节点按广度优先编号，根节点为0；每个节点的子边连续存放，并按字的码位排序
+查找下一个字时在当前节点的子边区间内用bisect二分（bisect在C中执行，数组用memoryview按下标读取），每个字只需一次二分
+根节点的子节点有上万个，每个起点都要查一次，单独存一张按码位直接索引的表
+
+文件格式（小端，各数组按8字节对齐）：
+    文件头: magic(8字节) 词数 节点数 最长词长(uint64) 总词频 最小词频(float64) 首字表起始码位 首字表长度(uint64)
+    root_table: uint32[首字表长度]  码位为起始码位 + i的字对应的根节点子节点，不存在时为0（根节点不会是子节点）
+    edge_start: uint32[节点数 + 1]  第k个节点的子边为[edge_start[k], edge_start[k + 1])
+    edge_codes: uint32[节点数 - 1]  子边对应的字的码位
+    edge_nodes: uint32[节点数 - 1]  子边指向的节点
+    freqs:      float64[节点数]     节点对应的词的词频，不成词的节点为-1（词频不会为负）
+用法：python compiled_dict.py dict.txt dict.w4dict
+"""
+
+import sys
+import mmap
+import struct
+from bisect import bisect_left
+from collections import deque
+import numpy as np
+from dict_trie import DictTrie, WORD_END, load_word_freq
+
+MAGIC = b"W4DICT02"
+HEADER = struct.Struct("<8sQQQddQQ")
+COMPILED_SUFFIX = ".w4dict"
+NOT_WORD = -1.0
+
+
+def align8(n):
+    return (n + 7) // 8 * 8
+
+
+#将{词: 词频}编译成词典文件
+def build_compiled_dict(word_freq, path):
+    trie = DictTrie.from_dict(word_freq)
+    #广度优先遍历，节点的编号即为出队顺序，同一节点的子节点编号连续
+    edge_start = [0]
+    edge_codes = []
+    edge_nodes = []
+    freqs = []
+    queue = deque([trie.root])
+    node_count = 1
+    while queue:
+        node = queue.popleft()
+        freqs.append(node.get(WORD_END, NOT_WORD))
+        for char in sorted(char for char in node if char != WORD_END):
+            edge_codes.append(ord(char))
+            edge_nodes.append(node_count)
+            node_count += 1
+            queue.append(node[char])
+        edge_start.append(len(edge_codes))
+    #根节点的子边即为前edge_start[1]条边
+    root_codes = edge_codes[:edge_start[1]]
+    root_min_code = root_codes[0] if root_codes else 0
+    root_table = np.zeros(root_codes[-1] - root_min_code + 1 if root_codes else 0, dtype=np.uint32)
+    root_table[np.array(root_codes, dtype=np.int64) - root_min_code] = edge_nodes[:edge_start[1]]
+    header = HEADER.pack(MAGIC, trie.word_count, node_count, trie.max_word_len, float(trie.total), float(trie.min_freq or 0.0),
+                         root_min_code, len(root_table))
+    arrays = [root_table, np.array(edge_start, dtype=np.uint32), np.array(edge_codes, dtype=np.uint32),
+              np.array(edge_nodes, dtype=np.uint32), np.array(freqs, dtype=np.float64)]
+    with open(path, "wb") as f:
+        for block in [header] + [array.tobytes() for array in arrays]:
+            f.write(block)
+            f.write(b"\0" * (align8(len(block)) - len(block)))
+    return path
+
+
+#只读的编译词典，接口与DictTrie一致，可直接传给calc_dag
+class CompiledDict:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.word_count, node_count, self.max_word_len, self.total, min_freq, self.root_min_code, root_table_size = \
+            HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("不是编译后的词典文件（或为旧格式，需要重新编译）：%s" % path)
+        self.min_freq = min_freq or None
+        #memoryview按下标读取直接得到python的int/float，比numpy标量快得多
+        self.view = memoryview(self.buffer)
+        offset = align8(HEADER.size)
+        self.root_table, offset = self.array_view(offset, root_table_size, "I")
+        self.edge_start, offset = self.array_view(offset, node_count + 1, "I")
+        self.edge_codes, offset = self.array_view(offset, node_count - 1, "I")
+        self.edge_nodes, offset = self.array_view(offset, node_count - 1, "I")
+        self.freqs, offset = self.array_view(offset, node_count, "d")
+
+    def array_view(self, offset, count, fmt):
+        nbytes = count * struct.calcsize(fmt)
+        return self.view[offset:offset + nbytes].cast(fmt), offset + align8(nbytes)
+
+    #node的子节点中字为char的节点，不存在时返回None
+    def child(self, node, char):
+        code = ord(char)
+        if node == 0:
+            index = code - self.root_min_code
+            if 0 <= index < len(self.root_table) and self.root_table[index]:
+                return self.root_table[index]
+            return None
+        hi = self.edge_start[node + 1]
+        j = bisect_left(self.edge_codes, code, self.edge_start[node], hi)
+        if j < hi and self.edge_codes[j] == code:
+            return self.edge_nodes[j]
+        return None
+
+    def get(self, word, default=None):
+        node = 0
+        for char in word:
+            node = self.child(node, char)
+            if node is None:
+                return default
+        freq = self.freqs[node]
+        return default if freq == NOT_WORD else freq
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __len__(self):
+        return self.word_count
+
+    #与DictTrie.prefix_ends相同：从sentence[start]开始逐字向下走，没有对应的子节点时停止
+    #循环内把child展开并使用局部变量，这是分词中调用最多的地方
+    def prefix_ends(self, sentence, start):
+        ends = []
+        edge_start, edge_codes, edge_nodes, freqs = self.edge_start, self.edge_codes, self.edge_nodes, self.freqs
+        node = self.child(0, sentence[start]) if start < len(sentence) else None
+        if node is None:
+            return ends
+        if freqs[node] != NOT_WORD:
+            ends.append(start)
+        for i in range(start + 1, len(sentence)):
+            code = ord(sentence[i])
+            hi = edge_start[node + 1]
+            j = bisect_left(edge_codes, code, edge_start[node], hi)
+            if j == hi or edge_codes[j] != code:
+                break
+            node = edge_nodes[j]
+            if freqs[node] != NOT_WORD:
+                ends.append(i)
+        return ends
+
+    #memoryview全部释放后才能关闭mmap
+    def close(self):
+        for view in [self.root_table, self.edge_start, self.edge_codes, self.edge_nodes, self.freqs, self.view]:
+            view.release()
+        self.buffer.close()
+
+
+if __name__ == "__main__":
+    dict_path, output_path = sys.argv[1], sys.argv[2]
+    build_compiled_dict(load_word_freq(dict_path), output_path)
+    print("已编译词典：", output_path)
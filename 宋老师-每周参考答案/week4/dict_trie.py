@@ -0,0 +1,87 @@
+#coding: utf-8
+
+"""
+前缀树（Trie）词典
+calc_dag中对每个起点都要把片段一直扩展到句尾，再逐个去词典里查
+用前缀树存词典后，可以从起点开始逐字向下走，一旦没有任何词以当前片段为前缀就立即停止
+这样每个起点最多只走"词典最长词长度"步，整句的切分接近线性时间
+"""
+
+#节点中用空字符串作为key存储词频，空字符串不会和任何单字冲突
+WORD_END = ""
+
+
+#读取jieba格式的词频文件，每行形如：词 词频 [词性]，词频缺省时记为1
+def load_word_freq(path):
+    word_freq = {}
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            items = line.strip().split()
+            if not items:
+                continue
+            word_freq[items[0]] = float(items[1]) if len(items) > 1 else 1
+    return word_freq
+
+
+class DictTrie:
+    def __init__(self):
+        self.root = {}
+        self.word_count = 0   #词典中词的数量
+        self.total = 0        #所有词频之和，计算概率时使用
+        self.max_word_len = 0
+        self.min_freq = None  #最小词频，未登录的单字按此词频计算概率
+
+    #从python字典构建，形如{"经常":0.1, "经":0.05}
+    @classmethod
+    def from_dict(cls, word_freq):
+        trie = cls()
+        for word, freq in word_freq.items():
+            trie.add_word(word, freq)
+        return trie
+
+    #从jieba格式的词频文件构建，每行形如：词 词频 [词性]
+    @classmethod
+    def from_file(cls, path):
+        return cls.from_dict(load_word_freq(path))
+
+    def add_word(self, word, freq):
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        if WORD_END not in node:
+            self.word_count += 1
+        else:
+            self.total -= node[WORD_END]
+        node[WORD_END] = freq
+        self.total += freq
+        self.max_word_len = max(self.max_word_len, len(word))
+        if freq > 0 and (self.min_freq is None or freq < self.min_freq):
+            self.min_freq = freq
+
+    #查询词频，不在词典中返回default
+    def get(self, word, default=None):
+        node = self.root
+        for char in word:
+            node = node.get(char)
+            if node is None:
+                return default
+        return node.get(WORD_END, default)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __len__(self):
+        return self.word_count
+
+    #从sentence[start]开始逐字向下走，返回所有成词位置的结束下标
+    #例如sentence="经常有意见分歧"，start=0，返回[0, 1]，代表"经"和"经常"都是词
+    def prefix_ends(self, sentence, start):
+        ends = []
+        node = self.root
+        for i in range(start, len(sentence)):
+            node = node.get(sentence[i])
+            if node is None:  #没有任何词以当前片段为前缀，停止
+                break
+            if WORD_END in node:
+                ends.append(i)
+        return ends
@@ -0,0 +1,119 @@
+#coding: utf-8
+
+"""
+基于HMM的未登录词切分
+词典中没有任何词能匹配时，calc_dag只能把字单独切开，人名、新词会被切碎
+这里仿照jieba的finalseg，对连续的未匹配单字用B/M/E/S四状态的HMM做维特比解码
+B:词首 M:词中 E:词尾 S:单字成词
+只对未匹配的片段调用，词典完全覆盖的文本不会有任何额外开销
+"""
+
+import numpy as np
+
+STATES = "BMES"
+B, M, E, S = range(4)
+MIN_LOG = -3.14e100   #对数概率的下限，代替log(0)，与jieba一致
+
+
+class HMMSegmenter:
+    #log_start: [4]  log_trans: [4, 4]（行为前一状态，列为后一状态）
+    #char_index: {字: 行号}  log_emit: [字数 + 1, 4]，最后一行给训练中没见过的字
+    def __init__(self, log_start, log_trans, char_index, log_emit):
+        self.log_start = log_start
+        self.log_trans = log_trans
+        self.char_index = char_index
+        self.log_emit = log_emit
+        self.unknown_index = len(char_index)
+
+    #加载jieba自带的HMM参数（已经是对数概率）
+    @classmethod
+    def from_jieba(cls):
+        from jieba.finalseg.prob_start import P as start_p
+        from jieba.finalseg.prob_trans import P as trans_p
+        from jieba.finalseg.prob_emit import P as emit_p
+        log_start = np.array([start_p.get(s, MIN_LOG) for s in STATES])
+        log_trans = np.array([[trans_p[s].get(t, MIN_LOG) for t in STATES] for s in STATES])
+        chars = sorted(set(char for s in STATES for char in emit_p[s]))
+        char_index = dict((char, index) for index, char in enumerate(chars))
+        log_emit = np.zeros((len(chars) + 1, 4))
+        for j, s in enumerate(STATES):
+            log_emit[:-1, j] = [emit_p[s].get(char, MIN_LOG) for char in chars]
+        return cls(log_start, log_trans, char_index, log_emit)
+
+    #从分好词的语料训练，每行是空格分开的词
+    @classmethod
+    def train(cls, lines):
+        start_count = np.zeros(4)
+        trans_count = np.zeros((4, 4))
+        char_index = {}
+        emit_rows = []
+        for line in lines:
+            tags = []
+            chars = []
+            for word in line.split():
+                tags += [S] if len(word) == 1 else [B] + [M] * (len(word) - 2) + [E]
+                chars += list(word)
+            if not tags:
+                continue
+            start_count[tags[0]] += 1
+            for prev, tag in zip(tags, tags[1:]):
+                trans_count[prev, tag] += 1
+            for char, tag in zip(chars, tags):
+                if char not in char_index:
+                    char_index[char] = len(emit_rows)
+                    emit_rows.append(np.zeros(4))
+                emit_rows[char_index[char]][tag] += 1
+        emit_count = np.array(emit_rows + [np.zeros(4)]).reshape(-1, 4)
+        with np.errstate(divide="ignore"):
+            log_start = np.log(start_count / max(start_count.sum(), 1))
+            log_trans = np.log(trans_count / np.maximum(trans_count.sum(axis=1, keepdims=True), 1))
+        #发射概率做加一平滑，没见过的字在各状态上概率相同
+        log_emit = np.log((emit_count + 1) / (emit_count.sum(axis=0) + len(emit_count)))
+        log_emit[-1] = 0
+        return cls(np.maximum(log_start, MIN_LOG), np.maximum(log_trans, MIN_LOG), char_index, log_emit)
+
+    #维特比解码，每一步只做一次4x4的向量化运算，整体对句长线性
+    def viterbi(self, text):
+        emit = self.log_emit[[self.char_index.get(char, self.unknown_index) for char in text]]  #[len, 4]
+        score = self.log_start + emit[0]
+        back = np.zeros((len(text), 4), dtype=np.int8)
+        for t in range(1, len(text)):
+            candidates = score[:, None] + self.log_trans  #[前一状态, 当前状态]
+            back[t] = candidates.argmax(axis=0)
+            score = candidates.max(axis=0) + emit[t]
+        #句子只能以E或S结尾
+        state = E if score[E] >= score[S] else S
+        tags = [state]
+        for t in range(len(text) - 1, 0, -1):
+            state = back[t, state]
+            tags.append(state)
+        return tags[::-1]
+
+    def cut(self, text):
+        if len(text) <= 1:
+            return [text] if text else []
+        words = []
+        begin = 0
+        for i, tag in enumerate(self.viterbi(text)):
+            if tag == E or tag == S:
+                words.append(text[begin:i + 1])
+                begin = i + 1
+        if begin < len(text):
+            words.append(text[begin:])
+        return words
+
+    #把切分结果中连续的、词典里没有的单字收集起来交给HMM重新切分
+    def recut_unknown(self, words, trie):
+        result = []
+        buffer = ""
+        for word in words:
+            if len(word) == 1 and trie.get(word) is None:
+                buffer += word
+                continue
+            if buffer:
+                result += self.cut(buffer)
+                buffer = ""
+            result.append(word)
+        if buffer:
+            result += self.cut(buffer)
+        return result
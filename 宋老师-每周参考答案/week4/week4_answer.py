@@ -1,4 +1,7 @@
+import math
+import heapq
 import jieba
+from dict_trie import DictTrie
 # jieba.cut
 #词典，每个词后方存储的是其词频，仅为示例，也可自行添加
 Dict = {"经常":0.1,
@@ -14,30 +17,28 @@ Dict = {"经常":0.1,
         "见分歧":0.05,
         "分":0.1}
 
+#前缀树词典只构建一次，所有calc_dag调用共享
+#也可以用DictTrie.from_file加载jieba格式的词频文件
+dict_trie = DictTrie.from_dict(Dict)
+
 
 #根据上方词典，对于输入文本，构造一个存储有所有切分方式的信息字典
 #学术叫法为有向无环图，DAG（Directed Acyclic Graph），不理解也不用纠结，只当是个专属名词就好
-#这段代码直接来自于jieba分词
+#这段代码直接来自于jieba分词，词典改为前缀树存储
 # jieba.cut
-def calc_dag(sentence):
+def calc_dag(sentence, trie=None):
+        if trie is None:
+            trie = dict_trie
         DAG = {}    #DAG空字典，用来存储DAG有向无环图
         N = len(sentence)
         for k in range(N):
-            tmplist = []
-            i = k
-            frag = sentence[k]
-            while i < N:
-                if frag in Dict:
-                    tmplist.append(i)
-                i += 1
-                frag = sentence[k:i + 1]
+            #从第k个字开始沿前缀树逐字向下走，没有词以当前片段为前缀时立即停止，不必扩展到句尾
+            tmplist = trie.prefix_ends(sentence, k)
             if not tmplist:
                 tmplist.append(k)
             DAG[k] = tmplist
         return DAG
 
-sentence = "经常有意见分歧"
-print(calc_dag(sentence))
 #结果应该为{0: [0, 1], 1: [1], 2: [2, 4], 3: [3, 4], 4: [4, 6], 5: [5, 6], 6: [6]}
 #0:[0,1]代表句子中的第0个字，可以单独成词，或与第1个字一起成词
 #2:[2,4]代表句子中的第2个字，可以单独成词，或第2-4个字一起成词
@@ -78,7 +79,114 @@ class DAGDecode:
             self.decode_next(path)     #使用该序列进行解码
 
 
-sentence = "经常有意见分歧"
-dd = DAGDecode(sentence)
-dd.decode()
-print(dd.finish_path)
\ No newline at end of file
+#上面的做法会把所有中间路径都复制一份保存在队列里，切分数量指数增长时内存会耗尽
+#这里用深度优先的生成器逐个产出切分结果：所有候选共享同一条路径前缀，回溯时只弹出最后一个词
+#按DAG中候选词从短到长的顺序遍历，输出顺序是确定的；limit用于只取前若干个结果
+def iter_segmentations(sentence, limit=None, trie=None):
+    N = len(sentence)
+    if N == 0 or limit == 0:
+        return
+    DAG = calc_dag(sentence, trie)
+    path = []              #当前路径，第j层的候选都接在path[:j]之后
+    starts = [0]           #每一层对应的起始位置
+    stack = [iter(DAG[0])] #每一层尚未尝试的候选结束位置
+    count = 0
+    while stack:
+        end = next(stack[-1], None)
+        if end is None:    #该层候选已尝试完，回溯
+            stack.pop()
+            starts.pop()
+            if path:
+                path.pop()
+            continue
+        path.append(sentence[starts[-1]:end + 1])
+        if end + 1 == N:
+            yield list(path)
+            count += 1
+            if limit is not None and count >= limit:
+                return
+            path.pop()
+        else:
+            starts.append(end + 1)
+            stack.append(iter(DAG[end + 1]))
+
+
+#只统计切分方式的数量，不构造具体切分
+#count[i]表示从第i个字到句尾的切分方式数量，count[i] = sum(count[x + 1] for x in DAG[i])
+def count_segmentations(sentence, trie=None):
+    N = len(sentence)
+    DAG = calc_dag(sentence, trie)
+    count = [0] * N + [1]
+    for idx in range(N - 1, -1, -1):
+        count[idx] = sum(count[x + 1] for x in DAG[idx])
+    return count[0] if N else 0
+
+
+#全切分的数量随句长指数增长，实际使用时只需要概率最大的那一种（或前k种）
+#仿照jieba的calc，从句尾向句首做动态规划：route[idx]记录从idx到句尾的最优切分
+#每个词的得分为log(词频/总词频)，整句得分为各词得分之和
+#保留前k个结果即为k-best，复杂度O(N * 最长词长 * k)
+def calc_route(sentence, DAG, topk=1, trie=None):
+    if trie is None:
+        trie = dict_trie
+    N = len(sentence)
+    logtotal = math.log(trie.total)
+    unknown_freq = trie.min_freq or 1
+    #route[idx]中每一项为(得分, 第一个词的结束下标, 在route[结束下标+1]中接续的名次)
+    route = {N: [(0.0, 0, 0)]}
+    for idx in range(N - 1, -1, -1):
+        candidates = []
+        for x in DAG[idx]:
+            word_score = math.log(trie.get(sentence[idx:x + 1]) or unknown_freq) - logtotal
+            for rank, (score, _, _) in enumerate(route[x + 1]):
+                candidates.append((word_score + score, x, rank))
+        route[idx] = heapq.nlargest(topk, candidates)
+    return route
+
+
+#基于动态规划的解码，只返回最优（或前k个）切分
+#传入hmm（见hmm.py中的HMMSegmenter）时，连续的未登录单字会再用HMM切分一次
+class DAGBestDecode:
+    def __init__(self, sentence, trie=None, hmm=None):
+        self.sentence = sentence
+        self.trie = trie
+        self.hmm = hmm
+        self.DAG = calc_dag(sentence, trie)
+        self.length = len(sentence)
+
+    #返回概率最大的切分方式
+    def decode(self):
+        path = self.decode_topk(1)[0][0]
+        if self.hmm is not None:
+            path = self.hmm.recut_unknown(path, self.trie or dict_trie)
+        return path
+
+    #返回前k个切分方式，形如[(["经常", "有意见", "分歧"], 得分), ...]
+    def decode_topk(self, k):
+        if self.length == 0:
+            return [([], 0.0)]
+        route = calc_route(self.sentence, self.DAG, k, self.trie)
+        results = []
+        for score, end, rank in route[0]:
+            path = []
+            start = 0
+            while start < self.length:
+                path.append(self.sentence[start:end + 1])
+                start = end + 1
+                _, end, rank = route[start][rank]
+            results.append((path, score))
+        return results
+
+
+if __name__ == "__main__":
+    sentence = "经常有意见分歧"
+    print(calc_dag(sentence))
+    dd = DAGDecode(sentence)
+    dd.decode()
+    print(dd.finish_path)
+    for path in iter_segmentations(sentence, limit=3):
+        print(path)
+    print(count_segmentations(sentence))
+    bd = DAGBestDecode(sentence)
+    print(bd.decode())
+    print(bd.decode_topk(3))
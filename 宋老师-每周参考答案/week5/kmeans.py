@@ -0,0 +1,178 @@
+#coding: utf-8
+
+"""
+基于numpy的Kmeans实现
+作业中常见的手写KMeansClusterer逐个坐标用python循环计算距离、用列表拼接收集结果、每轮迭代递归调用一次，
+数据稍大就会超出递归深度，且运算量为O(N*K*D)次python操作
+这里保持相同的cluster()接口，改为：
+1. 分块计算[块大小, K]的平方距离矩阵 ||x||^2 - 2x·c + ||c||^2，内存可控
+2. k-means++初始化（每步多候选的贪心版本）
+3. 循环迭代，中心移动量小于tol或达到最大迭代次数时停止
+聚类数很大时（如N=400万，K=2000），每轮都要算N*K的距离，可以设置assign_mode="approx"，
+先把中心再聚成约sqrt(K)组，每个点只和最近的nprobe组内的中心比较，并用assignment_recall抽样评估与精确分配的一致率
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class KMeansClusterer:
+    def __init__(self, ndarray, cluster_num, max_iter=300, tol=1e-4, chunk_size=65536, init="k-means++", seed=None,
+                 assign_mode="exact", nprobe=3, init_sample_size=None):
+        if cluster_num <= 0 or cluster_num > ndarray.shape[0]:
+            raise Exception("簇数设置有误")
+        self.ndarray = np.asarray(ndarray)
+        if self.ndarray.dtype != np.float32:
+            self.ndarray = self.ndarray.astype(np.float64)
+        self.cluster_num = cluster_num
+        self.max_iter = max_iter
+        self.chunk_size = chunk_size
+        self.assign_mode = assign_mode
+        self.nprobe = nprobe
+        self.rng = np.random.default_rng(seed)
+        #与sklearn一致，收敛阈值相对于数据各维方差的均值
+        self.tol = tol * np.mean(np.var(self.ndarray, axis=0))
+        self.squared_norms = np.einsum("ij,ij->i", self.ndarray, self.ndarray)
+        if init == "k-means++":
+            #聚类数很大时k-means++本身也需要O(N*K)次距离计算，可以只在抽样的部分点上初始化
+            sample = np.arange(len(self.ndarray))
+            if init_sample_size is not None and init_sample_size < len(self.ndarray):
+                sample = self.rng.choice(len(self.ndarray), max(init_sample_size, cluster_num), replace=False)
+            self.points = self.__kmeans_plus_plus(self.ndarray[sample], self.squared_norms[sample])
+        else:
+            self.points = self.ndarray[self.rng.choice(len(self.ndarray), cluster_num, replace=False)].copy()
+
+    #返回(每个簇的点, 中心点, 所有点到所属中心的距离之和)，与原手写实现一致
+    #每个簇的点为ndarray，形状[簇内点数, 维度]
+    def cluster(self):
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            labels, min_distances = self.assign(self.points)
+            new_center = self.__center(labels, min_distances)
+            shift = np.sum(np.square(new_center - self.points))
+            self.points = new_center
+            if shift <= self.tol:  #中心点基本不再变化，说明达到稳态
+                break
+        labels, min_distances = self.assign(self.points)
+        self.labels_ = labels
+        self.cluster_centers_ = self.points
+        self.inertia_ = float(np.sum(min_distances))
+        order = np.argsort(labels, kind="stable")
+        result = np.split(self.ndarray[order], np.cumsum(np.bincount(labels, minlength=self.cluster_num))[:-1])
+        return result, self.points, float(np.sum(np.sqrt(min_distances)))
+
+    #分块计算每个点最近的中心，返回(类别, 到该中心的平方距离)
+    def assign(self, centers):
+        if self.assign_mode == "approx":
+            return CoarseCentroidIndex(centers, self.nprobe, seed=self.rng.integers(1 << 31)).search(
+                self.ndarray, self.squared_norms, self.chunk_size)
+        return self.exact_assign(centers)
+
+    def exact_assign(self, centers):
+        centers_squared_norms = np.einsum("ij,ij->i", centers, centers)
+        labels = np.empty(len(self.ndarray), dtype=np.int64)
+        min_distances = np.empty(len(self.ndarray), dtype=self.ndarray.dtype)
+        for start in range(0, len(self.ndarray), self.chunk_size):
+            end = start + self.chunk_size
+            distances = self.squared_norms[start:end, None] - 2 * (self.ndarray[start:end] @ centers.T) + centers_squared_norms
+            labels[start:end] = np.argmin(distances, axis=1)
+            min_distances[start:end] = np.maximum(distances[np.arange(len(distances)), labels[start:end]], 0)
+        return labels, min_distances
+
+    #随机抽取部分点，比较近似分配与精确分配的类别，返回一致的比例
+    def assignment_recall(self, sample_size=10000):
+        sample = self.rng.choice(len(self.ndarray), min(sample_size, len(self.ndarray)), replace=False)
+        exact_labels = np.argmin(self.squared_norms[sample, None] - 2 * (self.ndarray[sample] @ self.points.T)
+                                 + np.einsum("ij,ij->i", self.points, self.points), axis=1)
+        return float(np.mean(exact_labels == self.labels_[sample]))
+
+    #用稀疏的one-hot矩阵乘以数据，一次得到各簇的坐标和
+    #空簇移到离自己中心最远的点上
+    def __center(self, labels, min_distances):
+        one_hot = csr_matrix((np.ones(len(labels), dtype=self.ndarray.dtype), (labels, np.arange(len(labels)))),
+                             shape=(self.cluster_num, len(labels)))
+        counts = np.bincount(labels, minlength=self.cluster_num)
+        centers = np.asarray(one_hot @ self.ndarray) / np.maximum(counts, 1)[:, None]
+        empty = np.where(counts == 0)[0]
+        if len(empty):
+            farthest = np.argsort(-min_distances)[:len(empty)]
+            centers[empty] = self.ndarray[farthest]
+        return centers.astype(self.ndarray.dtype)
+
+    #k-means++：第一个中心随机选，之后按到已选中心最近距离的平方为概率选下一个中心
+    #与sklearn相同，每次抽取2+log(K)个候选，保留使总距离下降最多的一个，高维数据上比只抽一个稳定得多
+    def __kmeans_plus_plus(self, ndarray, squared_norms):
+        n = len(ndarray)
+        n_local_trials = 2 + int(np.log(self.cluster_num))
+        indexes = [self.rng.integers(n)]
+        closest = self.__squared_distance_to(ndarray, squared_norms, ndarray[indexes[0]])[:, 0]
+        for _ in range(1, self.cluster_num):
+            total = closest.sum()
+            if total > 0:
+                candidates = self.rng.choice(n, n_local_trials, p=closest / total)
+            else:
+                candidates = self.rng.integers(n, size=n_local_trials)
+            #所有候选的距离用一次矩阵乘法算出，shape: [N, 候选数]
+            candidate_closest = np.minimum(closest[:, None], self.__squared_distance_to(ndarray, squared_norms, ndarray[candidates]))
+            best = np.argmin(candidate_closest.sum(axis=0))
+            indexes.append(candidates[best])
+            closest = candidate_closest[:, best].copy()
+        return ndarray[indexes].copy()
+
+    #所有点到points中每个点的平方距离，shape: [N, len(points)]
+    def __squared_distance_to(self, ndarray, squared_norms, points):
+        points = np.atleast_2d(points)
+        distances = squared_norms[:, None] - 2 * (ndarray @ points.T) + np.einsum("ij,ij->i", points, points)
+        return np.maximum(distances, 0).astype(np.float64)
+
+
+#中心点的粗粒度索引
+#把K个中心用kmeans聚成约sqrt(K)组，查询时先找离每个点最近的nprobe个组，只与这些组内的中心计算距离
+#按组处理：同一组的所有查询点与该组的中心做一次矩阵乘法，总计算量约为N * nprobe * sqrt(K)，而不是N * K
+class CoarseCentroidIndex:
+    def __init__(self, centers, nprobe=3, n_groups=None, seed=None):
+        self.centers = centers
+        self.centers_squared_norms = np.einsum("ij,ij->i", centers, centers)
+        n_groups = n_groups or max(1, int(np.sqrt(len(centers))))
+        grouper = KMeansClusterer(centers, n_groups, max_iter=20, seed=seed)
+        grouper.cluster()
+        self.group_centers = grouper.cluster_centers_
+        self.group_centers_squared_norms = np.einsum("ij,ij->i", self.group_centers, self.group_centers)
+        self.members = [np.where(grouper.labels_ == group)[0] for group in range(n_groups)]
+        self.nprobe = min(nprobe, n_groups)
+
+    #返回(类别, 到该中心的平方距离)，与KMeansClusterer.exact_assign相同
+    def search(self, ndarray, squared_norms, chunk_size=65536):
+        labels = np.empty(len(ndarray), dtype=np.int64)
+        min_distances = np.empty(len(ndarray), dtype=ndarray.dtype)
+        for start in range(0, len(ndarray), chunk_size):
+            end = start + chunk_size
+            labels[start:end], min_distances[start:end] = self.search_chunk(ndarray[start:end], squared_norms[start:end])
+        return labels, min_distances
+
+    def search_chunk(self, x, x_squared_norms):
+        group_distances = x_squared_norms[:, None] - 2 * (x @ self.group_centers.T) + self.group_centers_squared_norms
+        probes = np.argpartition(group_distances, self.nprobe - 1, axis=1)[:, :self.nprobe]
+        #把(点, 组)对按组排序，得到每个组需要查询的点
+        order = np.argsort(probes.ravel(), kind="stable")
+        rows_by_group = np.split(order // self.nprobe, np.cumsum(np.bincount(probes.ravel(), minlength=len(self.members)))[:-1])
+        best_labels = np.zeros(len(x), dtype=np.int64)
+        best_distances = np.full(len(x), np.inf)
+        for members, rows in zip(self.members, rows_by_group):
+            if len(rows) == 0 or len(members) == 0:
+                continue
+            distances = x_squared_norms[rows, None] - 2 * (x[rows] @ self.centers[members].T) + self.centers_squared_norms[members]
+            nearest = np.argmin(distances, axis=1)
+            nearest_distances = distances[np.arange(len(rows)), nearest]
+            better = nearest_distances < best_distances[rows]
+            best_distances[rows[better]] = nearest_distances[better]
+            best_labels[rows[better]] = members[nearest[better]]
+        return best_labels, np.maximum(best_distances, 0)
+
+
+if __name__ == "__main__":
+    x = np.random.rand(100, 8)
+    kmeans = KMeansClusterer(x, 10)
+    result, centers, distances = kmeans.cluster()
+    print([len(points) for points in result])
+    print(centers)
+    print(distances)
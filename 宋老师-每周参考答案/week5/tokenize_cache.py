@@ -0,0 +1,111 @@
+#coding: utf-8
+
+"""
+标题分词结果的缓存
+jieba分词是聚类流程中最慢的一步，而标题文件不变时每次的分词结果都一样
+这里用多进程对标题分词，把结果存成词表 + 词编号数组，缓存文件名取标题文件内容的哈希
+标题文件不变时直接读取缓存，完全跳过分词；分词结果以编号数组保存，也不再需要空格拼接再拆开
+"""
+
+import os
+import hashlib
+from multiprocessing import Pool, cpu_count
+import jieba
+import numpy as np
+
+CACHE_DIR = "token_cache"
+#缓存文件格式变化时修改，旧格式的缓存自动失效
+CACHE_VERSION = b"2"
+
+
+#按文件内容和jieba版本计算缓存的key，文件内容或分词器变化时缓存自动失效
+def file_hash(path):
+    md5 = hashlib.md5(jieba.__version__.encode("utf8") + CACHE_VERSION)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+#读取标题并去重，保持首次出现的顺序，跳过空行
+def load_titles(path):
+    titles = {}
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            title = line.strip()
+            if title:
+                titles[title] = None
+    return list(titles)
+
+
+#jieba.lcut是默认分词器实例的方法，无法传给子进程，需要包一层模块级函数
+def cut_title(title):
+    return jieba.lcut(title)
+
+
+def tokenize_titles(titles, workers=None, chunksize=1000):
+    workers = workers or cpu_count()
+    if workers == 1 or len(titles) < chunksize:
+        return [cut_title(title) for title in titles]
+    with Pool(workers) as pool:
+        return pool.map(cut_title, titles, chunksize=chunksize)
+
+
+def join_lines(strings):
+    return np.frombuffer("\n".join(strings).encode("utf8"), dtype=np.uint8)
+
+
+def split_lines(buffer):
+    text = buffer.tobytes().decode("utf8")
+    return text.split("\n") if text else []
+
+
+#分好词的标题集合
+#titles: 标题列表  words: 分词结果中出现的所有词
+#token_ids: 所有标题的词编号首尾相连（int32，编号对应words）  lengths: 每个标题的词数
+class TokenizedTitles:
+    def __init__(self, titles, words, token_ids, lengths):
+        self.titles = titles
+        self.words = words
+        self.token_ids = token_ids
+        self.lengths = lengths
+
+    @classmethod
+    def build(cls, titles, workers=None):
+        word_to_id = {}
+        token_ids = []
+        lengths = []
+        for tokens in tokenize_titles(titles, workers):
+            lengths.append(len(tokens))
+            token_ids += [word_to_id.setdefault(token, len(word_to_id)) for token in tokens]
+        return cls(titles, list(word_to_id), np.array(token_ids, dtype=np.int32), np.array(lengths, dtype=np.int64))
+
+    #标题和词用换行拼接后按utf8字节存储，np.array(字符串列表)是定长数组，每行都按最长的字符串占用4字节/字
+    #标题是去掉首尾空白的行，词是标题的一部分，都不含换行
+    def save(self, path):
+        np.savez(path, titles=join_lines(self.titles), words=join_lines(self.words),
+                 token_ids=self.token_ids, lengths=self.lengths)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(split_lines(data["titles"]), split_lines(data["words"]), data["token_ids"], data["lengths"])
+
+    def __len__(self):
+        return len(self.titles)
+
+
+#加载标题文件的分词结果，有缓存时直接读取缓存
+def load_tokenized_titles(path, workers=None, cache_dir=CACHE_DIR):
+    cache_path = os.path.join(cache_dir, "%s.npz" % file_hash(path))
+    if os.path.isfile(cache_path):
+        print("读取分词缓存：", cache_path)
+        return TokenizedTitles.load(cache_path)
+    corpus = TokenizedTitles.build(load_titles(path), workers)
+    os.makedirs(cache_dir, exist_ok=True)
+    #先写临时文件再改名，中途被中断时不会留下不完整的缓存文件
+    tmp_path = "%s.tmp%d.npz" % (cache_path[:-len(".npz")], os.getpid())
+    corpus.save(tmp_path)
+    os.replace(tmp_path, cache_path)
+    print("分词结果已缓存：", cache_path)
+    return corpus
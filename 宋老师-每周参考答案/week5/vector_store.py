@@ -0,0 +1,112 @@
+#coding: utf-8
+
+"""
+只读的词向量存储
+Word2Vec.load需要反序列化整个gensim模型，每个进程各占一份内存；模型文件不存在时还要重新训练
+这里把词向量导出到store_dir下以训练语料（或模型文件）哈希命名的子目录中：
+    vectors.npy  float32矩阵，第i行是第i个词的向量，用mmap方式打开，毫秒级完成，多个进程共享同一份页缓存
+    vocab.txt    每行一个词，行号即为向量的行号
+哈希变化时在临时目录中生成新的存储，再改名为新哈希对应的子目录，已打开旧存储的进程不受影响
+同时启动的多个进程用文件锁保证只有一个进程训练，其余进程等待后直接打开
+"""
+
+import os
+import shutil
+import hashlib
+import numpy as np
+try:
+    import fcntl
+except ImportError:  #windows下没有fcntl，不加锁，并发生成时各自训练，改名保证结果完整
+    fcntl = None
+
+
+#计算训练语料的哈希，corpus为句子列表，每个句子可以是原始字符串，也可以是分好词的列表
+#用原始字符串计算时不需要先分词，启动更快
+def corpus_hash(corpus):
+    md5 = hashlib.md5()
+    for sentence in corpus:
+        md5.update((sentence if isinstance(sentence, str) else " ".join(sentence)).encode("utf8"))
+        md5.update(b"\n")
+    return md5.hexdigest()
+
+
+#模型文件的指纹，用文件大小和修改时间代替全文哈希，避免每次启动都读一遍大文件
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return "%s:%d:%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class VectorStore:
+    #path为某个哈希对应的子目录，一般通过open_or_build或open_latest打开
+    def __init__(self, path):
+        self.path = path
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(path, "vocab.txt"), encoding="utf8") as f:
+            self.index_to_key = f.read().split("\n")[:len(self.vectors)]
+        self.key_to_index = dict((word, index) for index, word in enumerate(self.index_to_key))
+        self.vector_size = self.vectors.shape[1]
+        #与gensim的Word2Vec模型保持相同的用法：model.wv[word]、word in model.wv、model.wv.vectors
+        self.wv = self
+
+    def __contains__(self, word):
+        return word in self.key_to_index
+
+    def __getitem__(self, word):
+        return self.vectors[self.key_to_index[word]]
+
+    def __len__(self):
+        return len(self.index_to_key)
+
+    #从gensim的KeyedVectors（model.wv）导出到version_dir
+    #先写入临时目录，写完后改名，其他进程永远不会看到写了一半的文件，也不会覆盖正在被mmap的文件
+    #version_dir已存在（其他进程先生成好了）时放弃本次结果
+    @staticmethod
+    def build(keyed_vectors, version_dir):
+        tmp_dir = "%s.tmp%d" % (version_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, "vectors.npy"), np.ascontiguousarray(keyed_vectors.vectors, dtype=np.float32))
+        with open(os.path.join(tmp_dir, "vocab.txt"), "w", encoding="utf8") as f:
+            f.write("\n".join(keyed_vectors.index_to_key))
+        try:
+            os.replace(tmp_dir, version_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(version_dir):
+                raise
+
+    #source_hash对应的子目录，哈希可能是含路径的字符串（见file_fingerprint），再取一次md5作为目录名
+    @staticmethod
+    def version_path(store_dir, source_hash):
+        return os.path.join(store_dir, hashlib.md5(source_hash.encode("utf8")).hexdigest())
+
+    #source_hash对应的存储已存在时直接打开，否则调用train_fn得到gensim模型并导出
+    @classmethod
+    def open_or_build(cls, store_dir, source_hash, train_fn):
+        version_dir = cls.version_path(store_dir, source_hash)
+        if not os.path.isdir(version_dir):
+            os.makedirs(store_dir, exist_ok=True)
+            with open(os.path.join(store_dir, ".lock"), "w") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                #拿到锁后再检查一次，等待期间可能已经由其他进程生成
+                if not os.path.isdir(version_dir):
+                    cls.build(train_fn().wv, version_dir)
+                    cls.remove_old_versions(store_dir, version_dir)
+        return cls(version_dir)
+
+    #不知道来源哈希时（如模型文件已删除）打开最新生成的存储
+    @classmethod
+    def open_latest(cls, store_dir):
+        versions = [os.path.join(store_dir, name) for name in os.listdir(store_dir) if ".tmp" not in name]
+        versions = [path for path in versions if os.path.isdir(path)]
+        if not versions:
+            raise FileNotFoundError("没有可用的词向量存储：%s" % store_dir)
+        return cls(max(versions, key=os.path.getmtime))
+
+    #删除其他哈希的旧存储；已经mmap打开这些文件的进程仍可继续使用，文件在它们关闭后才真正释放
+    @staticmethod
+    def remove_old_versions(store_dir, version_dir):
+        for name in os.listdir(store_dir):
+            path = os.path.join(store_dir, name)
+            if path != version_dir and os.path.isdir(path) and ".tmp" not in name:
+                shutil.rmtree(path, ignore_errors=True)
@@ -2,80 +2,174 @@
 
 #基于训练好的词向量模型进行聚类
 #聚类采用Kmeans算法
+import os
 import math
+import argparse
 import re
 import json
 import jieba
 import numpy as np
 from gensim.models import Word2Vec
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from scipy.sparse import csr_matrix
 from collections import defaultdict
+from tokenize_cache import load_tokenized_titles
+from kmeans import KMeansClusterer
+from vector_store import VectorStore, file_fingerprint
 
 #输入模型文件路径
 #加载训练好的模型
+#词向量导出为mmap打开的只读存储（见vector_store.py），模型文件未变化时不再反序列化整个gensim模型
 def load_word2vec_model(path):
-    model = Word2Vec.load(path)
+    store_dir = path + ".store"
+    if not os.path.isfile(path):
+        return VectorStore.open_latest(store_dir)
+    model = VectorStore.open_or_build(store_dir, file_fingerprint(path), lambda: Word2Vec.load(path))
     return model
 
-def load_sentence(path):
-    sentences = set()
-    with open(path, encoding="utf8") as f:
-        for line in f:
-            sentence = line.strip()
-            sentences.add(" ".join(jieba.cut(sentence)))
-    print("获取句子数量：", len(sentences))
-    return sentences
-
 #将文本向量化
-def sentences_to_vectors(sentences, model):
-    vectors = []
+#先把所有句子的词一次性映射成词表下标，再用一次稀疏矩阵乘法完成所有句子的"词向量求和再平均"
+#dtype可以指定为np.float32，内存减半
+def sentences_to_vectors(sentences, model, dtype=np.float64):
+    key_to_index = model.wv.key_to_index
+    lengths = []
+    token_indices = []
     for sentence in sentences:
         words = sentence.split()  #sentence是分好词的，空格分开
-        vector = np.zeros(model.vector_size)
-        #所有词的向量相加求平均，作为句子向量
-        for word in words:
-            try:
-                vector += model.wv[word]
-            except KeyError:
-                #部分词在训练中未出现，用全0向量代替
-                vector += np.zeros(model.vector_size)
-        vectors.append(vector / len(words))
-    return np.array(vectors)
-
-
-def main():
+        lengths.append(len(words))
+        token_indices += [key_to_index.get(word, -1) for word in words]  #部分词在训练中未出现，记为-1
+    return tokens_to_vectors(np.array(token_indices, dtype=np.int64), np.array(lengths, dtype=np.int64), model.wv.vectors, dtype)
+
+#对已缓存的分词结果向量化：先把分词词表映射到词向量词表（只需做一次），再按编号取下标
+def tokenized_titles_to_vectors(corpus, model, dtype=np.float64):
+    key_to_index = model.wv.key_to_index
+    word_index = np.array([key_to_index.get(word, -1) for word in corpus.words], dtype=np.int64)
+    return tokens_to_vectors(word_index[corpus.token_ids], corpus.lengths, model.wv.vectors, dtype)
+
+#token_indices: 所有句子的词下标首尾相连，未登录词为-1
+#lengths: 每个句子的词数
+#构造一个[句子数, 词表大小]的稀疏矩阵，第i行在句子i的词的位置上填1/词数，乘以词向量矩阵即得到平均向量
+#未登录词用掩码去掉，相当于用全0向量代替
+def tokens_to_vectors(token_indices, lengths, word_vectors, dtype=np.float64):
+    sentence_ids = np.repeat(np.arange(len(lengths)), lengths)  #每个词属于第几个句子
+    mask = token_indices >= 0
+    weights = (1.0 / np.maximum(lengths, 1)).astype(dtype)[sentence_ids[mask]]
+    matrix = csr_matrix((weights, (sentence_ids[mask], token_indices[mask])),
+                        shape=(len(lengths), word_vectors.shape[0]), dtype=dtype)
+    return np.asarray(matrix @ word_vectors, dtype=dtype)
+
+#approx_nprobe不为None时改用kmeans.py中的KMeansClusterer，通过中心点粗索引近似分配类别，适合聚类数很大的情况
+#n_clusters为None时聚类数取标题数的平方根
+def main(approx_nprobe=None, titles_path="titles.txt", n_clusters=None):
     model = load_word2vec_model("model.w2v") #加载词向量模型
-    sentences = load_sentence("titles.txt")  #加载所有标题
-    vectors = sentences_to_vectors(sentences, model)   #将所有标题向量化
+    corpus = load_tokenized_titles(titles_path)  #加载所有标题的分词结果，标题文件不变时直接读缓存
+    print("获取句子数量：", len(corpus))
+    sentences = corpus.titles
+    vectors = tokenized_titles_to_vectors(corpus, model)   #将所有标题向量化
 
-    n_clusters = int(math.sqrt(len(sentences)))  #指定聚类数量
+    if n_clusters is None:
+        n_clusters = int(math.sqrt(len(sentences)))  #指定聚类数量
     print("指定聚类数量：", n_clusters)
-    kmeans = KMeans(n_clusters)  #定义一个kmeans计算类
-    kmeans.fit(vectors)          #进行聚类计算
+    if approx_nprobe is None:
+        kmeans = KMeans(n_clusters)  #定义一个kmeans计算类
+        kmeans.fit(vectors)          #进行聚类计算
+    else:
+        kmeans = KMeansClusterer(vectors, n_clusters, assign_mode="approx", nprobe=approx_nprobe,
+                                 init_sample_size=50 * n_clusters)
+        kmeans.cluster()
+        print("近似分配与精确分配的一致率：", kmeans.assignment_recall())
 
     sentence_label_dict = defaultdict(list)
     for sentence, label in zip(sentences, kmeans.labels_):  #取出句子和标签
         sentence_label_dict[label].append(sentence)         #同标签的放到一起
 
-    #计算类内距离
-    density_dict = defaultdict(list)
-    for vector_index, label in enumerate(kmeans.labels_):
-        vector = vectors[vector_index]   #某句话的向量
-        center = kmeans.cluster_centers_[label]  #对应的类别中心向量
-        distance = cosine_distance(vector, center)  #计算距离
-        density_dict[label].append(distance)    #保存下来
-    for label, distance_list in density_dict.items():
-        density_dict[label] = np.mean(distance_list)   #对于每一类，将类内所有文本到中心的向量余弦值取平均
-    density_order = sorted(density_dict.items(), key=lambda x:x[1], reverse=True)  #按照平均距离排序，向量夹角余弦值越接近1，距离越小
+    #计算类内距离，按类内平均余弦值排序
+    density_order = rank_clusters_by_density(vectors, kmeans.labels_, kmeans.cluster_centers_)
 
     #按照余弦距离顺序输出
-    for label, distance_avg in density_order:
+    for label, distance_avg, size in density_order:
         print("cluster %s , avg distance %f: " % (label, distance_avg))
         sentences = sentence_label_dict[label]
         for i in range(min(10, len(sentences))):  #随便打印几个，太多了看不过来
-            print(sentences[i].replace(" ", ""))
+            print(sentences[i])
         print("---------")
 
+#行向量l2归一化，之后两个向量的点积即为余弦值
+def normalize_rows(matrix):
+    norms = np.sqrt(np.sum(np.square(matrix), axis=1, keepdims=True))
+    return matrix / np.maximum(norms, 1e-12)  #全0向量保持为0，避免除0
+
+#每一类内所有向量到本类中心的余弦值之和，以及每一类的向量数
+#向量和中心各归一化一次，按标签取出每个向量对应的中心后逐行点积，再用bincount按类别累加
+def cluster_cosine_sums(vectors, labels, centers):
+    vectors = normalize_rows(vectors)
+    centers = normalize_rows(centers)
+    cosines = np.einsum("ij,ij->i", vectors, centers[labels])
+    sums = np.bincount(labels, weights=cosines, minlength=len(centers))
+    sizes = np.bincount(labels, minlength=len(centers))
+    return sums, sizes
+
+#对每一类，将类内所有文本到中心的向量余弦值取平均，按平均值从大到小排序
+#向量夹角余弦值越接近1，距离越小，类越紧密
+#返回[(类别, 平均余弦值, 类内向量数), ...]，不包含空的类
+def rank_density(sums, sizes):
+    averages = sums / np.maximum(sizes, 1)
+    order = [label for label in np.argsort(-averages, kind="stable") if sizes[label] > 0]
+    return [(int(label), float(averages[label]), int(sizes[label])) for label in order]
+
+def rank_clusters_by_density(vectors, labels, centers):
+    return rank_density(*cluster_cosine_sums(vectors, labels, centers))
+
+#流式聚类：标题文件过大时，无法把所有标题和向量同时放进内存
+#第一遍按块读取标题，用mini-batch kmeans逐块更新聚类中心；第二遍再按块读取，预测类别并写出
+#内存只与块大小和聚类数有关，不随语料规模增长（因此也不再对标题去重）
+def iter_title_chunks(path, chunk_size):
+    chunk = []
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            title = line.strip()
+            if not title:
+                continue
+            chunk.append(title)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def titles_to_vectors(titles, model):
+    return sentences_to_vectors([" ".join(jieba.cut(title)) for title in titles], model, np.float32)
+
+def count_titles(path):
+    with open(path, encoding="utf8") as f:
+        return sum(1 for line in f if line.strip())
+
+def streaming_cluster(model, titles_path, output_path, n_clusters=None, chunk_size=10000, epochs=1):
+    if n_clusters is None:
+        n_clusters = int(math.sqrt(count_titles(titles_path)))  #与main中一致，聚类数取标题数的平方根
+    print("指定聚类数量：", n_clusters)
+    chunk_size = max(chunk_size, 3 * n_clusters)  #首个块用于初始化中心，样本数不能少于聚类数
+    kmeans = MiniBatchKMeans(n_clusters, batch_size=chunk_size, n_init=3)
+    for epoch in range(epochs):
+        for index, titles in enumerate(iter_title_chunks(titles_path, chunk_size)):
+            kmeans.partial_fit(titles_to_vectors(titles, model))
+            print("第%d轮，已训练%d块" % (epoch + 1, index + 1))
+    #第二遍：逐块预测类别，每行输出"类别\t标题"
+    #同时逐块累加类内余弦值，最后得到与main中相同的类内密度排序
+    cosine_sums = np.zeros(n_clusters)
+    cluster_sizes = np.zeros(n_clusters, dtype=np.int64)
+    with open(output_path, "w", encoding="utf8") as f:
+        for titles in iter_title_chunks(titles_path, chunk_size):
+            vectors = titles_to_vectors(titles, model)
+            labels = kmeans.predict(vectors)
+            sums, sizes = cluster_cosine_sums(vectors, labels, kmeans.cluster_centers_)
+            cosine_sums += sums
+            cluster_sizes += sizes
+            for title, label in zip(titles, labels):
+                f.write("%d\t%s\n" % (label, title))
+    print("聚类结果已写入：", output_path)
+    return kmeans, rank_density(cosine_sums, cluster_sizes)
+
 #向量余弦距离
 def cosine_distance(vec1, vec2):
     vec1 = vec1 / np.sqrt(np.sum(np.square(vec1)))  #A/|A|
@@ -87,4 +181,18 @@ def eculid_distance(vec1, vec2):
     return np.sqrt((np.sum(np.square(vec1 - vec2))))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true", help="流式聚类，适用于内存放不下的大规模标题文件")
+    parser.add_argument("--titles", default="titles.txt")
+    parser.add_argument("--output", default="cluster_result.txt", help="流式聚类的输出文件")
+    parser.add_argument("--n_clusters", type=int, default=None)
+    parser.add_argument("--chunk_size", type=int, default=10000, help="流式聚类每块的标题数")
+    parser.add_argument("--epochs", type=int, default=1, help="流式聚类训练的轮数")
+    parser.add_argument("--approx_nprobe", type=int, default=None, help="聚类数很大时，只在最近的若干组中心中查找最近中心")
+    args = parser.parse_args()
+    if args.stream:
+        kmeans, density_order = streaming_cluster(load_word2vec_model("model.w2v"), args.titles, args.output, args.n_clusters, args.chunk_size, args.epochs)
+        for label, distance_avg, size in density_order:
+            print("cluster %s , avg distance %f, size %d" % (label, distance_avg, size))
+    else:
+        main(args.approx_nprobe, args.titles, args.n_clusters)
\ No newline at end of file
@@ -1,36 +1,201 @@
-import torch
-import math
-import torch.nn as nn
-import numpy as np
-from transformers import BertModel
-
-model = BertModel.from_pretrained(r"F:\Desktop\work_space\pretrain_models\bert-base-chinese", return_dict=False)
-n = 2                       # 输入最大句子个数
-vocab = 21128               # 词表数目
-max_sequence_length = 512   # 最大句子长度
-embedding_size = 768        # embedding维度
-hide_size = 3072            # 隐藏层维数
-num_layers = 1             # 隐藏层层数
-
-# embedding过程中的参数，其中 vocab * embedding_size是词表embedding参数， max_sequence_length * embedding_size是位置参数， n * embedding_size是句子参数
-# embedding_size + embedding_sizes是layer_norm层参数
-embedding_parameters = vocab * embedding_size + max_sequence_length * embedding_size + n * embedding_size + embedding_size + embedding_size
-
-# self_attention过程的参数, 其中embedding_size * embedding_size是权重参数，embedding_size是bias， *3是K Q V三个
-self_attention_parameters = (embedding_size * embedding_size + embedding_size) * 3
-
-# self_attention_out参数 其中 embedding_size * embedding_size + embedding_size + embedding_size是self输出的线性层参数，embedding_size + embedding_size是layer_norm层参数
-self_attention_out_parameters = embedding_size * embedding_size + embedding_size + embedding_size + embedding_size
-
-# Feed Forward参数 其中embedding_size * hide_size + hide_size第一个线性层，embedding_size * hide_size + embedding_size第二个线性层，
-# embedding_size + embedding_size是layer_norm层
-feed_forward_parameters = embedding_size * hide_size + hide_size + embedding_size * hide_size + embedding_size + embedding_size + embedding_size
-
-# pool_fc层参数
-pool_fc_parameters = embedding_size * embedding_size + embedding_size
-
-# 模型总参数 = embedding层参数 + self_attention参数 + self_attention_out参数 + Feed_Forward参数 + pool_fc层参数
-all_paramerters = embedding_parameters + (self_attention_parameters + self_attention_out_parameters + \
-    feed_forward_parameters) * num_layers + pool_fc_parameters
-print("模型实际参数个数为%d" % sum(p.numel() for p in model.parameters()))
-print("diy计算参数个数为%d" % all_paramerters)
+#coding: utf-8
+
+"""
+bert类模型的参数量、计算量与显存估算
+只读取config.json，不加载权重，支持bert、roberta（结构与bert相同）和albert（embedding降维 + 层间参数共享）
+输出：
+    1. 各模块参数量
+    2. 给定句长、batch大小时每个token的前向FLOPs（乘加各算一次），训练约为前向的3倍
+    3. 推理和训练时的激活值显存，训练时的权重/梯度/Adam状态显存
+    4. 逐字解码时（见week6 diy_bert的decode_step）缓存k、v所需的显存
+用法：python model_parameters.py --config bert-base-chinese/config.json --seq_len 512 --batch_size 8 --check
+--check时用transformers按同一config随机初始化模型，与真实参数量逐模块对比
+"""
+
+import os
+import json
+import argparse
+
+DEFAULT_MODEL_PATH = r"F:\Desktop\work_space\pretrain_models\bert-base-chinese"
+
+
+#读取config.json，path可以是文件，也可以是模型目录
+def load_config(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, "config.json")
+    with open(path, encoding="utf8") as f:
+        config = json.load(f)
+    hidden_size = config["hidden_size"]
+    return {"model_type": config.get("model_type", "bert"),
+            "vocab_size": config["vocab_size"],
+            "hidden_size": hidden_size,
+            "embedding_size": config.get("embedding_size", hidden_size),   #只有albert的embedding维度与hidden_size不同
+            "num_hidden_layers": config["num_hidden_layers"],
+            "num_attention_heads": config["num_attention_heads"],
+            "intermediate_size": config["intermediate_size"],
+            "max_position_embeddings": config["max_position_embeddings"],
+            "type_vocab_size": config.get("type_vocab_size", 2),
+            #albert的层分为num_hidden_groups组，每组inner_group_num层，所有层循环使用这些参数
+            "num_hidden_groups": config.get("num_hidden_groups", 1),
+            "inner_group_num": config.get("inner_group_num", 1)}
+
+
+#参数量不同的层数：bert每层单独一份参数，albert只有num_hidden_groups * inner_group_num份
+def num_parameter_layers(config):
+    if config["model_type"] == "albert":
+        return config["num_hidden_groups"] * config["inner_group_num"]
+    return config["num_hidden_layers"]
+
+
+#各模块参数量，键与module_of_parameter的返回值对应
+def count_parameters(config):
+    vocab = config["vocab_size"]
+    embedding_size = config["embedding_size"]
+    hidden_size = config["hidden_size"]
+    intermediate_size = config["intermediate_size"]
+    layers = num_parameter_layers(config)
+    parameters = {}
+    # 词表、位置、句子类型三个embedding，加上layer_norm的weight和bias
+    parameters["embeddings"] = (vocab + config["max_position_embeddings"] + config["type_vocab_size"]) * embedding_size + 2 * embedding_size
+    # albert把embedding_size维的embedding映射到hidden_size维
+    if embedding_size != hidden_size or config["model_type"] == "albert":
+        parameters["embedding_hidden_mapping_in"] = embedding_size * hidden_size + hidden_size
+    # self_attention：q、k、v和输出线性层各为hidden_size * hidden_size的权重加bias，再加layer_norm
+    parameters["attention"] = layers * (4 * (hidden_size * hidden_size + hidden_size) + 2 * hidden_size)
+    # feed forward：两个线性层加layer_norm
+    parameters["feed_forward"] = layers * (2 * hidden_size * intermediate_size + intermediate_size + hidden_size + 2 * hidden_size)
+    # pooler层：[cls]位置的线性层
+    parameters["pooler"] = hidden_size * hidden_size + hidden_size
+    return parameters
+
+
+#每个token的前向FLOPs，一次乘加记为2次浮点运算，只统计矩阵乘法（layer_norm、softmax等相比可以忽略）
+#注意力部分与句长有关：每个token要与seq_len个位置计算q·k和加权求和v
+def flops_per_token(config, seq_len):
+    hidden_size = config["hidden_size"]
+    flops = {}
+    if config["embedding_size"] != hidden_size or config["model_type"] == "albert":
+        flops["embedding_hidden_mapping_in"] = 2 * config["embedding_size"] * hidden_size
+    layers = config["num_hidden_layers"]   #albert的参数共享不减少计算量
+    flops["qkv_projection"] = layers * 2 * 3 * hidden_size * hidden_size
+    flops["attention_scores"] = layers * 2 * 2 * seq_len * hidden_size
+    flops["attention_output"] = layers * 2 * hidden_size * hidden_size
+    flops["feed_forward"] = layers * 2 * 2 * hidden_size * config["intermediate_size"]
+    return flops
+
+
+#激活值占用的字节数
+#训练：反向传播需要保存的中间结果，逐项列出每层保存的张量，dropout的mask按1字节计
+#推理：不保存中间结果，按单层计算时同时存在的最大张量估计峰值
+def activation_memory(config, seq_len, batch_size, bytes_per_element=4):
+    tokens = seq_len * batch_size
+    hidden_size = config["hidden_size"]
+    intermediate_size = config["intermediate_size"]
+    scores = batch_size * config["num_attention_heads"] * seq_len * seq_len   # 注意力矩阵的元素个数
+    # 每层保存：qkv投影的输入、q、k、v、注意力输出线性层的输入、两个layer_norm的输入、feed forward的输入，共8个[tokens, hidden_size]
+    # feed forward中gelu的输入和输出各一个[tokens, intermediate_size]
+    # softmax的输出和dropout后的注意力矩阵
+    saved_elements = 8 * tokens * hidden_size + 2 * tokens * intermediate_size + 2 * scores
+    # attention矩阵的dropout和两处残差前的dropout
+    saved_masks = scores + 2 * tokens * hidden_size
+    training = config["num_hidden_layers"] * (saved_elements * bytes_per_element + saved_masks)
+    # 推理：残差输入与q、k、v，加上注意力矩阵（softmax前后各一份）和feed forward中间结果（gelu前后各一份）中较大的一个
+    inference = (4 * tokens * hidden_size + max(2 * scores, 2 * tokens * intermediate_size)) * bytes_per_element
+    return {"training": training, "inference": inference}
+
+
+#逐字解码时每层缓存的k、v：2 * 层数 * batch_size * seq_len * hidden_size
+def kv_cache_memory(config, seq_len, batch_size, bytes_per_element=4):
+    return 2 * config["num_hidden_layers"] * batch_size * seq_len * config["hidden_size"] * bytes_per_element
+
+
+def estimate(config, seq_len=512, batch_size=1, bytes_per_element=4):
+    parameters = count_parameters(config)
+    total_parameters = sum(parameters.values())
+    flops = flops_per_token(config, seq_len)
+    forward_flops = sum(flops.values())
+    return {"parameters": parameters,
+            "total_parameters": total_parameters,
+            "flops_per_token": flops,
+            "forward_flops_per_token": forward_flops,
+            "forward_flops_per_batch": forward_flops * seq_len * batch_size,
+            "training_flops_per_batch": 3 * forward_flops * seq_len * batch_size,   # 反向传播约为前向的2倍
+            "weight_memory": total_parameters * bytes_per_element,
+            # 训练时还有同样大小的梯度，Adam的一阶、二阶动量按float32存储
+            "training_state_memory": total_parameters * (2 * bytes_per_element + 8),
+            "activation_memory": activation_memory(config, seq_len, batch_size, bytes_per_element),
+            "kv_cache_memory": kv_cache_memory(config, seq_len, batch_size, bytes_per_element)}
+
+
+#真实模型中参数名对应的模块
+def module_of_parameter(name):
+    if name.startswith("embeddings."):
+        return "embeddings"
+    if "embedding_hidden_mapping_in" in name:
+        return "embedding_hidden_mapping_in"
+    if name.startswith("pooler."):
+        return "pooler"
+    if ".attention." in name:
+        return "attention"
+    return "feed_forward"
+
+
+#按config随机初始化真实模型，逐模块对比参数量，返回不一致的模块{模块: (估算值, 实际值)}
+def check_against_model(config_path):
+    from transformers import AutoConfig, AutoModel
+    model = AutoModel.from_config(AutoConfig.from_pretrained(config_path))
+    actual = {}
+    for name, parameter in model.named_parameters():
+        module = module_of_parameter(name)
+        actual[module] = actual.get(module, 0) + parameter.numel()
+    estimated = count_parameters(load_config(config_path))
+    mismatch = {}
+    for module in set(actual) | set(estimated):
+        if actual.get(module, 0) != estimated.get(module, 0):
+            mismatch[module] = (estimated.get(module, 0), actual.get(module, 0))
+    return mismatch
+
+
+def format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024
+    return "%.1fTB" % size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="bert类模型参数量、计算量与显存估算")
+    parser.add_argument("--config", default=DEFAULT_MODEL_PATH, help="config.json或模型目录")
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--bytes_per_element", type=int, default=4, help="float32为4，float16为2")
+    parser.add_argument("--check", action="store_true", help="与transformers随机初始化的真实模型对比参数量")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    report = estimate(config, args.seq_len, args.batch_size, args.bytes_per_element)
+    print("模型类型：%s，层数：%d，hidden_size：%d" % (config["model_type"], config["num_hidden_layers"], config["hidden_size"]))
+    for module, count in report["parameters"].items():
+        print("%-30s 参数量：%d" % (module, count))
+    print("diy计算参数个数为%d" % report["total_parameters"])
+    print("句长%d，batch大小%d：" % (args.seq_len, args.batch_size))
+    print("每个token前向计算量：%.2f MFLOPs" % (report["forward_flops_per_token"] / 1e6))
+    print("每个batch前向计算量：%.3f GFLOPs，训练约%.3f GFLOPs" %
+          (report["forward_flops_per_batch"] / 1e9, report["training_flops_per_batch"] / 1e9))
+    print("权重显存：%s，训练时权重+梯度+Adam状态：%s" %
+          (format_bytes(report["weight_memory"]), format_bytes(report["training_state_memory"])))
+    print("激活值显存 推理峰值：%s，训练：%s" %
+          (format_bytes(report["activation_memory"]["inference"]), format_bytes(report["activation_memory"]["training"])))
+    print("k、v缓存显存：%s" % format_bytes(report["kv_cache_memory"]))
+    if args.check:
+        mismatch = check_against_model(args.config)
+        if mismatch:
+            for module, (estimated, actual) in mismatch.items():
+                print("%s 参数量不一致：估算%d，实际%d" % (module, estimated, actual))
+        else:
+            print("各模块参数量与真实模型一致")
+    return report
+
+
+if __name__ == "__main__":
+    main()
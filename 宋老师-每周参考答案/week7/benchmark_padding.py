@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import argparse
+import torch
+import numpy as np
+from config import Config
+from model import TorchModel, choose_optimizer
+from loader import load_data
+
+"""
+固定补齐到max_length与按长度分桶、动态补齐的对比
+1. 训练一轮的速度：每秒处理的真实token数（不含padding）
+2. 同一个模型在验证集上的预测：两种补齐方式的输出应当一致，准确率不变
+用法：python benchmark_padding.py --model_type lstm --max_length 100
+"""
+
+
+def train_speed(config, model, data):
+    optimizer = choose_optimizer(config, model)
+    model.train()
+    real_tokens = 0
+    padded_tokens = 0
+    start_time = time.time()
+    for input_ids, labels in data:
+        optimizer.zero_grad()
+        loss = model(input_ids, labels)
+        loss.backward()
+        optimizer.step()
+        real_tokens += int((input_ids != 0).sum())
+        padded_tokens += input_ids.numel()
+    cost = time.time() - start_time
+    return real_tokens / cost, padded_tokens, real_tokens
+
+
+def predict(model, data):
+    model.eval()
+    with torch.no_grad():
+        return torch.cat([model(input_ids) for input_ids, _ in data]), torch.cat([labels for _, labels in data]).squeeze(-1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="固定补齐与动态补齐的速度对比")
+    parser.add_argument("--model_type", default="lstm")
+    parser.add_argument("--max_length", type=int, default=Config["max_length"])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--pooling_style", default=Config["pooling_style"])
+    args = parser.parse_args(argv)
+    config = dict(Config, model_type=args.model_type, max_length=args.max_length,
+                  batch_size=args.batch_size, pooling_style=args.pooling_style)
+    torch.manual_seed(config["seed"])
+    np.random.seed(config["seed"])
+    datasets = {}
+    for dynamic_padding in [False, True]:
+        config["dynamic_padding"] = dynamic_padding
+        datasets[dynamic_padding] = (load_data(config["train_data_path"], config),
+                                     load_data(config["valid_data_path"], config, shuffle=False))
+    model = TorchModel(config)
+    initial_state = dict((name, value.clone()) for name, value in model.state_dict().items())
+
+    #同一组参数下两种补齐方式的预测结果
+    predictions = {}
+    for dynamic_padding, (_, valid_data) in datasets.items():
+        predictions[dynamic_padding] = predict(model, valid_data)
+    for dynamic_padding, (logits, labels) in predictions.items():
+        print("%s 验证集准确率：%f" % ("动态补齐" if dynamic_padding else "固定补齐",
+                                  float((logits.argmax(dim=-1) == labels).float().mean())))
+    print("两种补齐方式预测结果最大误差：%e" % float((predictions[False][0] - predictions[True][0]).abs().max()))
+
+    #从相同的初始参数各训练一轮
+    speed = {}
+    for dynamic_padding, (train_data, _) in datasets.items():
+        model.load_state_dict(initial_state)
+        speed[dynamic_padding], padded_tokens, real_tokens = train_speed(config, model, train_data)
+        print("%s：%.0f token/秒，padding占比%.1f%%" % ("动态补齐" if dynamic_padding else "固定补齐",
+                                                speed[dynamic_padding], (1 - real_tokens / padded_tokens) * 100))
+    print("动态补齐加速%.2f倍" % (speed[True] / speed[False]))
+    return speed
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -17,9 +17,12 @@ Config = {
     "epoch": 5,
     "batch_size": 16,
     "pooling_style":"avg",
+    "last_k_layers": 4,
     "optimizer": "adam",
     "learning_rate": 1e-5,
     "pretrain_model_path":r"E:\pretrain_models\bert-base-chinese",
-    "seed": 987
+    "seed": 987,
+    "cache_dir": "cache",
+    "dynamic_padding": False
 }
 
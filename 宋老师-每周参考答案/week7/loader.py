@@ -3,12 +3,17 @@
 import json
 import re
 import os
+import hashlib
+import shutil
 import torch
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from transformers import BertTokenizer
 """
 数据加载
+分词结果缓存在cache_dir下，缓存目录名由数据文件内容、分词器词表和max_length计算得到，三者不变时直接读取缓存
+缓存中input_ids、labels为int32的npy文件，用mmap方式打开，启动时不需要再逐行分词，内存中也只有一块连续的数组
+dynamic_padding为True时，训练集按长度分桶组batch，每个batch只补齐到batch内最长的句子，减少padding位置上的计算
 """
 
 
@@ -28,7 +33,38 @@ class DataGenerator:
 
 
     def load(self):
-        self.data = []
+        cache_dir = os.path.join(self.config.get("cache_dir", "cache"), self.cache_key())
+        if not os.path.isdir(cache_dir):
+            self.build_cache(cache_dir)
+        self.input_ids = np.load(os.path.join(cache_dir, "input_ids.npy"), mmap_mode="r")  # shape: [样本数, max_length]
+        self.labels = np.load(os.path.join(cache_dir, "labels.npy"), mmap_mode="r")        # shape: [样本数]
+        with open(os.path.join(cache_dir, "sentences.txt"), encoding="utf8") as f:
+            self.sentences = f.read().split("\n")[:len(self.labels)]
+        #padding位置的编号为0，且都在句尾，非0的个数即为补齐前的长度
+        self.lengths = np.count_nonzero(self.input_ids, axis=1)
+        return
+
+    #数据文件、分词方式及词表、max_length任一变化时缓存失效
+    def cache_key(self):
+        md5 = hashlib.md5()
+        with open(self.path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                md5.update(block)
+        #只区分分词方式：bert用tokenizer的词表，其余模型都按chars.txt逐字编码，共用同一份缓存
+        if self.config["model_type"] == "bert":
+            tokenizer_kind, vocab = "bert", self.tokenizer.get_vocab()
+        else:
+            tokenizer_kind, vocab = "chars", self.vocab
+        md5.update(tokenizer_kind.encode("utf8"))
+        md5.update(json.dumps(vocab, sort_keys=True, ensure_ascii=False).encode("utf8"))
+        md5.update(str(self.config["max_length"]).encode("utf8"))
+        return md5.hexdigest()
+
+    #逐行分词并写入缓存，先写到临时目录，全部写完后再改名，中途失败不会留下不完整的缓存
+    def build_cache(self, cache_dir):
+        input_ids = []
+        labels = []
+        sentences = []
         with open(self.path, encoding="utf8") as f:
             for line in f:
                 if line.startswith("0,"):
@@ -39,14 +75,25 @@ class DataGenerator:
                     continue
                 title = line[2:].strip()
                 if self.config["model_type"] == "bert":
-                    input_id = self.tokenizer.encode(title, max_length=self.config["max_length"], pad_to_max_length=True)
+                    input_id = self.tokenizer.encode(title, max_length=self.config["max_length"], padding="max_length", truncation=True)
                 else:
                     input_id = self.encode_sentence(title)
-                self.sentences.append(title)
-                input_id = torch.LongTensor(input_id)
-                label_index = torch.LongTensor([label])
-                self.data.append([input_id, label_index])
-        return
+                sentences.append(title)
+                input_ids.append(input_id)
+                labels.append(label)
+        tmp_dir = cache_dir + ".tmp%d" % os.getpid()
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, "input_ids.npy"), np.array(input_ids, dtype=np.int32).reshape(-1, self.config["max_length"]))
+        np.save(os.path.join(tmp_dir, "labels.npy"), np.array(labels, dtype=np.int32))
+        with open(os.path.join(tmp_dir, "sentences.txt"), "w", encoding="utf8") as f:
+            f.write("\n".join(sentences))
+        #另一个进程已经写好了同一个缓存时os.replace会失败，直接使用已有的缓存
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(cache_dir):
+                raise
 
     def encode_sentence(self, text):
         input_id = []
@@ -62,10 +109,10 @@ class DataGenerator:
         return input_id
 
     def __len__(self):
-        return len(self.data)
+        return len(self.labels)
 
     def __getitem__(self, index):
-        return self.data[index]
+        return [torch.from_numpy(self.input_ids[index].astype(np.int64)), torch.LongTensor([self.labels[index]])]
 
 def load_vocab(vocab_path):
     token_dict = {}
@@ -76,9 +123,48 @@ def load_vocab(vocab_path):
     return token_dict
 
 
+#按长度分桶的batch采样器
+#shuffle=True时先打乱，每batch_size * bucket_batches个样本为一桶，桶内按长度排序后切成batch，最后打乱batch的顺序
+#这样每个batch内的句子长度相近，补齐的位置很少，同时batch之间仍然是随机的
+#shuffle=False时按原顺序切分，与不分桶时相同（评估时按下标对应原句）
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_batches=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+
+    def __iter__(self):
+        if not self.shuffle:
+            indexes = np.arange(len(self.lengths))
+            return iter([indexes[i:i + self.batch_size].tolist() for i in range(0, len(indexes), self.batch_size)])
+        indexes = np.random.permutation(len(self.lengths))
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indexes), bucket_size):
+            bucket = indexes[start:start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += [bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size)]
+        return iter([batches[i] for i in np.random.permutation(len(batches))])
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+#把batch内的样本拼起来，并截去所有样本都是padding的列，即只补齐到batch内最长的句子
+def collate_dynamic_padding(batch):
+    input_ids = torch.stack([item[0] for item in batch])
+    labels = torch.stack([item[1] for item in batch])
+    max_len = max(int((input_ids != 0).sum(dim=1).max()), 1)
+    return [input_ids[:, :max_len], labels]
+
+
 #用torch自带的DataLoader类封装数据
 def load_data(data_path, config, shuffle=True):
     dg = DataGenerator(data_path, config)
+    if config.get("dynamic_padding", False):
+        sampler = BucketBatchSampler(dg.lengths, config["batch_size"], shuffle)
+        return DataLoader(dg, batch_sampler=sampler, collate_fn=collate_dynamic_padding)
     dl = DataLoader(dg, batch_size=config["batch_size"], shuffle=shuffle)
     return dl
 
@@ -17,6 +17,8 @@ class TorchModel(nn.Module):
         model_type = config["model_type"]
         num_layers = config["num_layers"]
         self.use_bert = False
+        #卷积类的encoder需要mask：第一层之后padding位置不再是0，下一层卷积会在真实token的边缘读到这些位置
+        self.encoder_uses_mask = model_type in ("cnn", "gated_cnn", "stack_gated_cnn", "rcnn")
         self.embedding = nn.Embedding(vocab_size, hidden_size, padding_idx=0)
         if model_type == "fast_text":
             self.encoder = lambda x: x
@@ -53,36 +55,77 @@ class TorchModel(nn.Module):
 
         self.classify = nn.Linear(hidden_size, class_num)
         self.pooling_style = config["pooling_style"]
+        self.pooling_layer = MaskedPooling(self.pooling_style, config.get("last_k_layers", 4))
+        if self.pooling_style == "last_k_avg":
+            if model_type != "bert":
+                raise ValueError("last_k_avg只能用于model_type为bert的模型")
+            self.encoder.config.output_hidden_states = True
         self.loss = nn.functional.cross_entropy  #loss采用交叉熵损失
 
     #当输入真实标签，返回loss值；无真实标签，返回预测值
     def forward(self, x, target=None):
+        mask = (x != 0)  #padding位置为0，shape:(batch_size, sen_len)
         if self.use_bert:  # bert返回的结果是 (sequence_output, pooler_output)
             #sequence_output:batch_size, max_len, hidden_size
             #pooler_output:batch_size, hidden_size
-            x = self.encoder(x)
+            x = self.encoder(x, attention_mask=mask.long())
+        elif self.encoder_uses_mask:
+            x = self.embedding(x)  # input shape:(batch_size, sen_len)
+            x = self.encoder(x, mask)  # input shape:(batch_size, sen_len, input_dim)
         else:
             x = self.embedding(x)  # input shape:(batch_size, sen_len)
             x = self.encoder(x)  # input shape:(batch_size, sen_len, input_dim)
 
         if isinstance(x, tuple):  #RNN类的模型会同时返回隐单元向量，我们只取序列结果
-            x = x[0]
+            #last_k_avg需要bert每一层的输出，输出hidden_states时bert返回(sequence_output, pooler_output, hidden_states)
+            x = x[2] if self.pooling_style == "last_k_avg" else x[0]
         #可以采用pooling的方式得到句向量
-        if self.pooling_style == "max":
-            self.pooling_layer = nn.MaxPool1d(x.shape[1])
-        else:
-            self.pooling_layer = nn.AvgPool1d(x.shape[1])
-        x = self.pooling_layer(x.transpose(1, 2)).squeeze() #input shape:(batch_size, sen_len, input_dim)
+        x = self.pooling_layer(x, mask)  #output shape:(batch_size, input_dim)
 
         #也可以直接使用序列最后一个位置的向量
         # x = x[:, -1, :]
         predict = self.classify(x)   #input shape:(batch_size, input_dim)
         if target is not None:
-            return self.loss(predict, target.squeeze())
+            return self.loss(predict, target.view(-1))  #batch_size为1时squeeze会把target变成标量
         else:
             return predict
 
 
+#带mask的pooling，padding位置不参与计算
+#encoder内部也不让padding位置影响真实token（bert用attention_mask，卷积前把padding位置置0，rnn从左到右不受句尾padding影响），
+#这样无论batch补齐到多长，同一个句子的结果都相同
+#没有需要训练的参数，在模型初始化时创建一次，每次forward不再新建pooling层
+#pooling_style：
+#  avg：真实token的平均
+#  max：真实token每一维的最大值
+#  cls：第一个位置的向量，bert中即为[CLS]
+#  last_k_avg：bert最后k层输出的平均，再对真实token取平均
+class MaskedPooling(nn.Module):
+    def __init__(self, pooling_style="avg", last_k_layers=4):
+        super(MaskedPooling, self).__init__()
+        if pooling_style not in ("avg", "max", "cls", "last_k_avg"):
+            raise ValueError("不支持的pooling_style：%s" % pooling_style)
+        self.pooling_style = pooling_style
+        self.last_k_layers = last_k_layers
+
+    #x: (batch_size, sen_len, hidden_size)，last_k_avg时为bert各层输出组成的tuple
+    #mask: (batch_size, sen_len)，真实token为True
+    def forward(self, x, mask):
+        if self.pooling_style == "cls":
+            return x[:, 0]
+        if self.pooling_style == "last_k_avg":
+            layers = x[-self.last_k_layers:]
+            x = layers[0]
+            for layer in layers[1:]:
+                x = x + layer
+            x = x / len(layers)
+        mask = mask.unsqueeze(-1)  #shape:(batch_size, sen_len, 1)
+        if self.pooling_style == "max":
+            #没有真实token的行（如空标题）结果置0，避免finfo.min导致loss为nan
+            return x.masked_fill(~mask, torch.finfo(x.dtype).min).max(dim=1)[0].masked_fill(~mask.any(dim=1), 0)
+        return (x * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
 class CNN(nn.Module):
     def __init__(self, config):
         super(CNN, self).__init__()
@@ -91,7 +134,10 @@ class CNN(nn.Module):
         pad = int((kernel_size - 1)/2)
         self.cnn = nn.Conv1d(hidden_size, hidden_size, kernel_size, bias=False, padding=pad)
 
-    def forward(self, x): #x : (batch_size, max_len, embeding_size)
+    #mask: (batch_size, max_len)，传入时先把padding位置置0，避免卷积在句子边缘读到padding位置的值
+    def forward(self, x, mask=None): #x : (batch_size, max_len, embeding_size)
+        if mask is not None:
+            x = x * mask.unsqueeze(-1).to(x.dtype)
         return self.cnn(x.transpose(1, 2)).transpose(1, 2)
 
 class GatedCNN(nn.Module):
@@ -100,9 +146,9 @@ class GatedCNN(nn.Module):
         self.cnn = CNN(config)
         self.gate = CNN(config)
 
-    def forward(self, x):
-        a = self.cnn(x)
-        b = self.gate(x)
+    def forward(self, x, mask=None):
+        a = self.cnn(x, mask)
+        b = self.gate(x, mask)
         b = torch.sigmoid(b)
         return torch.mul(a, b)
 
@@ -129,10 +175,10 @@ class StackGatedCNN(nn.Module):
             nn.LayerNorm(self.hidden_size) for i in range(self.num_layers)
         )
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         #仿照bert的transformer模型结构，将self-attention替换为gcnn
         for i in range(self.num_layers):
-            gcnn_x = self.gcnn_layers[i](x)
+            gcnn_x = self.gcnn_layers[i](x, mask)  #残差和layer norm之后padding位置不再是0，每层卷积前都要mask
             x = gcnn_x + x  #通过gcnn+残差
             x = self.bn_after_gcnn[i](x)  #之后bn
             # # 仿照feed-forward层，使用两个线性层
@@ -150,9 +196,11 @@ class RCNN(nn.Module):
         self.rnn = nn.RNN(hidden_size, hidden_size)
         self.cnn = GatedCNN(config)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        if mask is not None:
+            x = x * mask.unsqueeze(-1).to(x.dtype)
         x, _ = self.rnn(x)
-        x = self.cnn(x)
+        x = self.cnn(x, mask)
         return x
 
 class BertLSTM(nn.Module):
@@ -161,8 +209,8 @@ class BertLSTM(nn.Module):
         self.bert = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
         self.rnn = nn.LSTM(self.bert.config.hidden_size, self.bert.config.hidden_size, batch_first=True)
 
-    def forward(self, x):
-        x = self.bert(x)[0]
+    def forward(self, x, attention_mask=None):
+        x = self.bert(x, attention_mask=attention_mask)[0]
         x, _ = self.rnn(x)
         return x
 
@@ -173,9 +221,9 @@ class BertCNN(nn.Module):
         config["hidden_size"] = self.bert.config.hidden_size
         self.cnn = CNN(config)
 
-    def forward(self, x):
-        x = self.bert(x)[0]
-        x = self.cnn(x)
+    def forward(self, x, attention_mask=None):
+        x = self.bert(x, attention_mask=attention_mask)[0]
+        x = self.cnn(x, attention_mask)  #bert输出中padding位置不为0
         return x
 
 class BertMidLayer(nn.Module):
@@ -184,8 +232,8 @@ class BertMidLayer(nn.Module):
         self.bert = BertModel.from_pretrained(config["pretrain_model_path"], return_dict=False)
         self.bert.config.output_hidden_states = True
 
-    def forward(self, x):
-        layer_states = self.bert(x)[2]#(13, batch, len, hidden)
+    def forward(self, x, attention_mask=None):
+        layer_states = self.bert(x, attention_mask=attention_mask)[2]#(13, batch, len, hidden)
         layer_states = torch.add(layer_states[-2], layer_states[-1])
         return layer_states
 
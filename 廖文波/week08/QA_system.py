@@ -1,10 +1,10 @@
-import os
 import json
 import jieba
 import numpy as np
 from bm25 import BM25
 from similarity_function import editing_distance, jaccard_distance
 from gensim.models import Word2Vec
+from vector_store import VectorStore, corpus_hash
 from model import SiameseNetwork
 from config import Config
 from torch import torch
@@ -64,21 +64,19 @@ class QASystem:
 
     #词向量的训练
     def load_word2vec(self):
-        #词向量的训练需要一定时间，如果之前训练过，我们就直接读取训练好的模型
-        #注意如果数据集更换了，应当重新训练
+        #词向量的训练需要一定时间，如果之前训练过，我们就直接读取训练好的词向量
+        #词向量导出为mmap打开的只读存储（见vector_store.py），启动只需毫秒级，多个服务进程共享同一份内存
+        #存储中记录了训练语料的哈希，数据集更换后会自动重新训练
         #当然，也可以收集一份大量的通用的语料，训练一个通用词向量模型。一般少量数据来训练效果不会太理想
-        if os.path.isfile("model.w2v"):
-            self.w2v_model = Word2Vec.load("model.w2v")
-        else:
-            #训练语料的准备，把所有问题分词后连在一起
-            corpus = []
-            for questions in self.target_to_questions.values():
-                for question in questions:
-                    corpus.append(jieba.lcut(question))
+        #哈希用原始问题文本计算，存储已存在时不需要对整个知识库分词；分词器版本变化时也重新训练
+        questions = [question for questions in self.target_to_questions.values() for question in questions]
+        source_hash = "%s:jieba%s" % (corpus_hash(questions), jieba.__version__)
+        #训练语料的准备，把所有问题分词，只在需要重新训练时执行
+        def train():
+            corpus = [jieba.lcut(question) for question in questions]
             #调用第三方库训练模型
-            self.w2v_model = Word2Vec(corpus, vector_size=100, min_count=1)
-            #保存模型
-            self.w2v_model.save("model.w2v")
+            return Word2Vec(corpus, vector_size=100, min_count=1)
+        self.w2v_model = VectorStore.open_or_build("w2v_store", source_hash, train)
         #借助词向量模型，将知识库中的问题向量化
         self.target_to_vectors = {}
         for target, questions in self.target_to_questions.items():
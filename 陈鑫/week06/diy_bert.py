@@ -1,101 +1,335 @@
-import torch
+import time
+import os
+import json
 import math
+import mmap
 import numpy as np
-from transformers import BertModel
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 
 通过手动矩阵运算实现Bert结构
 模型文件下载 https://huggingface.co/models
+numpy推理部分不依赖torch：先运行本文件把权重转换为平铺的二进制文件，之后用DiyBert.from_weight_file直接mmap加载
+文件中保存的是预处理（qkv拼接、转置、可选量化）之后的权重，加载时不做任何计算和复制，多个进程共享同一份页缓存
 
 '''
 
-bert = BertModel.from_pretrained(r"D:\八斗NLP课件\week06 语言模型和预训练\bert-base-chinese", return_dict=False)
-state_dict = bert.state_dict()
-bert.eval()
-x = np.array([2450, 15486, 102, 2110])   #假想成4个字的句子
-torch_x = torch.LongTensor([x])          #pytorch形式输入
-seqence_output, pooler_output = bert(torch_x)
-print(seqence_output.shape, pooler_output.shape)
-# print(seqence_output, pooler_output)
-
-print(bert.state_dict().keys())  #查看所有的权值矩阵名称
-
-#softmax归一化
+#torch的tensor转为numpy数组；从权重文件加载时本身就是numpy数组，直接返回
+def to_numpy(tensor):
+    if hasattr(tensor, "numpy"):
+        return tensor.numpy()
+    return np.asarray(tensor)
+
+#权重文件格式：魔数 + 8字节头部长度 + json头部 + 按64字节对齐的原始数据
+#json头部为{"meta": {...}, "tensors": {权重名: [偏移, 形状, 类型]}}
+#加载时用mmap映射整个文件，每个权重都是文件上的只读视图，不需要反序列化，也不需要安装torch
+WEIGHT_FILE_MAGIC = b"DIYBERT2"
+WEIGHT_ALIGN = 64
+
+#保存DiyBert.fused_state_dict()的结果，即预处理后的权重，weight_dtype、num_attention_heads见DiyBert
+#头数从权重中看不出来，写在头部的meta中，加载时读回
+def save_weight_file(state_dict, path, weight_dtype="float32", num_attention_heads=12):
+    model = DiyBert(state_dict, weight_dtype=weight_dtype, num_attention_heads=num_attention_heads)
+    tensors = {}
+    arrays = []
+    offset = 0
+    for name, array in model.fused_state_dict().items():
+        array = np.ascontiguousarray(array)
+        offset = (offset + WEIGHT_ALIGN - 1) // WEIGHT_ALIGN * WEIGHT_ALIGN
+        tensors[name] = [offset, list(array.shape), array.dtype.str]
+        arrays.append((offset, array))
+        offset += array.nbytes
+    meta = {"weight_dtype": weight_dtype, "num_layers": model.num_layers, "num_attention_heads": num_attention_heads}
+    header_bytes = json.dumps({"meta": meta, "tensors": tensors}).encode("utf8")
+    #数据区起点同样对齐，偏移量相对数据区起点
+    data_start = (len(WEIGHT_FILE_MAGIC) + 8 + len(header_bytes) + WEIGHT_ALIGN - 1) // WEIGHT_ALIGN * WEIGHT_ALIGN
+    with open(path, "wb") as f:
+        f.write(WEIGHT_FILE_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for offset, array in arrays:
+            f.seek(data_start + offset)
+            f.write(array.tobytes())
+
+#返回({权重名: numpy数组}, meta)，数组直接引用mmap的内存，只有实际用到的页才会从磁盘读入
+def load_weight_file(path):
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(WEIGHT_FILE_MAGIC)] != WEIGHT_FILE_MAGIC:
+        raise ValueError("不是DiyBert权重文件（或为旧格式，需要重新转换）：%s" % path)
+    header_size = int.from_bytes(buffer[len(WEIGHT_FILE_MAGIC):len(WEIGHT_FILE_MAGIC) + 8], "little")
+    header_end = len(WEIGHT_FILE_MAGIC) + 8 + header_size
+    header = json.loads(buffer[len(WEIGHT_FILE_MAGIC) + 8:header_end].decode("utf8"))
+    data_start = (header_end + WEIGHT_ALIGN - 1) // WEIGHT_ALIGN * WEIGHT_ALIGN
+    state_dict = {}
+    for name, (offset, shape, dtype) in header["tensors"].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        state_dict[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+    return state_dict, header["meta"]
+
+#state_dict中transformer层的层数，权重名形如encoder.layer.{层号}.xxx，预处理后的权重为fused.layer.{层号}.xxx
+def count_layers(state_dict):
+    return len(set(name.split(".")[2] for name in state_dict if name.startswith(("encoder.layer.", "fused.layer."))))
+
+#预处理后每层权重的名称，顺序与prepare_weights的结果一致
+FUSED_WEIGHT_NAMES = ["qkv_weight_t", "qkv_bias",
+                      "attention_output_weight_t", "attention_output_bias",
+                      "attention_layer_norm_weight", "attention_layer_norm_bias",
+                      "intermediate_weight_t", "intermediate_bias",
+                      "output_weight_t", "output_bias",
+                      "ff_layer_norm_weight", "ff_layer_norm_bias"]
+
+#softmax归一化，先减去最大值防止溢出
 def softmax(x):
-    return np.exp(x)/np.sum(np.exp(x), axis=-1, keepdims=True)
+    x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return x / np.sum(x, axis=-1, keepdims=True)
 
 #gelu激活函数
 def gelu(x):
     return 0.5 * x * (1 + np.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * np.power(x, 3))))
 
+#低精度存储的线性层权重，w_t为预先转置好的float32权重[in_size, out_size]
+#int8：每个输出通道（列）单独计算缩放系数，权重 ≈ int8值 * scale，内存为float32的1/4
+#float16：直接转为半精度存储，内存为float32的1/2
+#numpy没有int8/float16的高效矩阵乘法，计算时按输入维分块还原成float32，避免一次性还原整个矩阵
+class LowPrecisionWeight:
+    def __init__(self, w_t, weight_dtype, block_size=256):
+        self.shape = w_t.shape
+        self.block_size = block_size
+        if weight_dtype == "int8":
+            scale = np.max(np.abs(w_t), axis=0) / 127.0
+            scale[scale == 0] = 1.0
+            self.data = np.round(w_t / scale).astype(np.int8)
+            self.scale = scale.astype(np.float32)
+        elif weight_dtype == "float16":
+            self.data = w_t.astype(np.float16)
+            self.scale = None
+        else:
+            raise ValueError("不支持的权重精度：%s" % weight_dtype)
+        self.nbytes = self.data.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    #由已量化好的数据构造（如从权重文件mmap得到的数组），不做任何计算
+    @classmethod
+    def from_arrays(cls, data, scale=None, block_size=256):
+        weight = cls.__new__(cls)
+        weight.shape = data.shape
+        weight.block_size = block_size
+        weight.data = data
+        weight.scale = scale
+        weight.nbytes = data.nbytes + (scale.nbytes if scale is not None else 0)
+        return weight
+
+    # x.shape = [n, in_size]  output shape = [n, out_size]
+    def matmul(self, x):
+        output = np.zeros((x.shape[0], self.shape[1]), dtype=np.float32)
+        for start in range(0, self.shape[0], self.block_size):
+            end = start + self.block_size
+            output += x[:, start:end] @ self.data[start:end].astype(np.float32)
+        if self.scale is not None:
+            output *= self.scale
+        return output
+
+
 class DiyBert:
     #将预训练好的整个权重字典输入进来
-    def __init__(self, state_dict):
-        self.num_attention_heads = 12
-        self.hidden_size = 768
-        self.num_layers = 1        #注意这里的层数要跟预训练config.json文件中的模型层数一致
-        self.load_weights(state_dict)
+    #fuse_weights=True时，加载后做一次权重预处理，见prepare_weights
+    #weight_dtype可选"float32"、"float16"、"int8"，非float32时transformer层中线性层的权重以低精度存储，需要fuse_weights=True
+    #state_dict也可以是fused_state_dict()的结果（如从权重文件加载），此时直接使用其中预处理好的权重，weight_dtype由权重本身决定
+    #num_workers > 1时用线程池并行计算（numpy的矩阵运算会释放GIL），parallel_mode可选：
+    #  "batch"：batch内的句子分成num_workers份，每份在一个线程中完整地跑一遍forward，适合batch较大的情况
+    #  "heads"：注意力的各个头分成num_workers组并行计算，线性层仍整体计算，适合单句或batch很小的情况
+    #多线程时建议设置OMP_NUM_THREADS=1等环境变量关闭BLAS自身的多线程，避免线程数超过核数
+    #num_attention_heads从权重中看不出来，需与预训练config.json文件中的num_attention_heads一致
+    def __init__(self, state_dict, fuse_weights=True, weight_dtype=None, num_workers=1, parallel_mode="batch",
+                 num_attention_heads=12):
+        self.hidden_size = state_dict["embeddings.word_embeddings.weight"].shape[1]
+        if self.hidden_size % num_attention_heads != 0:
+            raise ValueError("hidden_size %d不能被头数%d整除" % (self.hidden_size, num_attention_heads))
+        self.num_attention_heads = num_attention_heads
+        self.num_layers = count_layers(state_dict)  #层数从权重名中得到，与config.json中的num_hidden_layers一致
+        if "fused.layer.0.qkv_bias" in state_dict:
+            if not fuse_weights:
+                raise ValueError("权重已是预处理后的布局，不能使用fuse_weights=False")
+            self.load_fused_weights(state_dict)
+            if weight_dtype is not None and weight_dtype != self.weight_dtype:
+                raise ValueError("权重精度为%s，与指定的%s不一致" % (self.weight_dtype, weight_dtype))
+        else:
+            self.weight_dtype = weight_dtype or "float32"
+            if self.weight_dtype != "float32" and not fuse_weights:
+                raise ValueError("低精度权重需要fuse_weights=True")
+            self.load_weights(state_dict)
+            self.fused_weights = self.prepare_weights() if fuse_weights else None
+        if parallel_mode not in ("batch", "heads"):
+            raise ValueError("parallel_mode只能是batch或heads：%s" % parallel_mode)
+        self.num_workers = num_workers
+        self.parallel_mode = parallel_mode
+        self.executor = ThreadPoolExecutor(num_workers) if num_workers > 1 else None
+
+    #从save_weight_file保存的文件加载，不依赖torch，头数取自文件的meta
+    @classmethod
+    def from_weight_file(cls, path, **kwargs):
+        state_dict, meta = load_weight_file(path)
+        num_attention_heads = kwargs.pop("num_attention_heads", meta["num_attention_heads"])
+        if num_attention_heads != meta["num_attention_heads"]:
+            raise ValueError("权重文件的头数为%d，与指定的%d不一致" % (meta["num_attention_heads"], num_attention_heads))
+        return cls(state_dict, num_attention_heads=num_attention_heads, **kwargs)
 
     def load_weights(self, state_dict):
         #embedding部分
-        self.word_embeddings = state_dict["embeddings.word_embeddings.weight"].numpy()
-        self.position_embeddings = state_dict["embeddings.position_embeddings.weight"].numpy()
-        self.token_type_embeddings = state_dict["embeddings.token_type_embeddings.weight"].numpy()
-        self.embeddings_layer_norm_weight = state_dict["embeddings.LayerNorm.weight"].numpy()
-        self.embeddings_layer_norm_bias = state_dict["embeddings.LayerNorm.bias"].numpy()
+        self.word_embeddings = to_numpy(state_dict["embeddings.word_embeddings.weight"])
+        self.position_embeddings = to_numpy(state_dict["embeddings.position_embeddings.weight"])
+        self.token_type_embeddings = to_numpy(state_dict["embeddings.token_type_embeddings.weight"])
+        self.embeddings_layer_norm_weight = to_numpy(state_dict["embeddings.LayerNorm.weight"])
+        self.embeddings_layer_norm_bias = to_numpy(state_dict["embeddings.LayerNorm.bias"])
+        #单输入时token type全为0，position embedding加上token type 0的向量，第i行即为位置i的两项之和
+        #所有长度共用这一份[max_position, hidden_size]的结果，长度为L时取前L行
+        self.position_type_embeddings = self.position_embeddings + self.token_type_embeddings[0]
         self.transformer_weights = []
         #transformer部分，有多层
         for i in range(self.num_layers):
-            q_w = state_dict["encoder.layer.%d.attention.self.query.weight" % i].numpy()
-            q_b = state_dict["encoder.layer.%d.attention.self.query.bias" % i].numpy()
-            k_w = state_dict["encoder.layer.%d.attention.self.key.weight" % i].numpy()
-            k_b = state_dict["encoder.layer.%d.attention.self.key.bias" % i].numpy()
-            v_w = state_dict["encoder.layer.%d.attention.self.value.weight" % i].numpy()
-            v_b = state_dict["encoder.layer.%d.attention.self.value.bias" % i].numpy()
-            attention_output_weight = state_dict["encoder.layer.%d.attention.output.dense.weight" % i].numpy()
-            attention_output_bias = state_dict["encoder.layer.%d.attention.output.dense.bias" % i].numpy()
-            attention_layer_norm_w = state_dict["encoder.layer.%d.attention.output.LayerNorm.weight" % i].numpy()
-            attention_layer_norm_b = state_dict["encoder.layer.%d.attention.output.LayerNorm.bias" % i].numpy()
-            intermediate_weight = state_dict["encoder.layer.%d.intermediate.dense.weight" % i].numpy()
-            intermediate_bias = state_dict["encoder.layer.%d.intermediate.dense.bias" % i].numpy()
-            output_weight = state_dict["encoder.layer.%d.output.dense.weight" % i].numpy()
-            output_bias = state_dict["encoder.layer.%d.output.dense.bias" % i].numpy()
-            ff_layer_norm_w = state_dict["encoder.layer.%d.output.LayerNorm.weight" % i].numpy()
-            ff_layer_norm_b = state_dict["encoder.layer.%d.output.LayerNorm.bias" % i].numpy()
+            q_w = to_numpy(state_dict["encoder.layer.%d.attention.self.query.weight" % i])
+            q_b = to_numpy(state_dict["encoder.layer.%d.attention.self.query.bias" % i])
+            k_w = to_numpy(state_dict["encoder.layer.%d.attention.self.key.weight" % i])
+            k_b = to_numpy(state_dict["encoder.layer.%d.attention.self.key.bias" % i])
+            v_w = to_numpy(state_dict["encoder.layer.%d.attention.self.value.weight" % i])
+            v_b = to_numpy(state_dict["encoder.layer.%d.attention.self.value.bias" % i])
+            attention_output_weight = to_numpy(state_dict["encoder.layer.%d.attention.output.dense.weight" % i])
+            attention_output_bias = to_numpy(state_dict["encoder.layer.%d.attention.output.dense.bias" % i])
+            attention_layer_norm_w = to_numpy(state_dict["encoder.layer.%d.attention.output.LayerNorm.weight" % i])
+            attention_layer_norm_b = to_numpy(state_dict["encoder.layer.%d.attention.output.LayerNorm.bias" % i])
+            intermediate_weight = to_numpy(state_dict["encoder.layer.%d.intermediate.dense.weight" % i])
+            intermediate_bias = to_numpy(state_dict["encoder.layer.%d.intermediate.dense.bias" % i])
+            output_weight = to_numpy(state_dict["encoder.layer.%d.output.dense.weight" % i])
+            output_bias = to_numpy(state_dict["encoder.layer.%d.output.dense.bias" % i])
+            ff_layer_norm_w = to_numpy(state_dict["encoder.layer.%d.output.LayerNorm.weight" % i])
+            ff_layer_norm_b = to_numpy(state_dict["encoder.layer.%d.output.LayerNorm.bias" % i])
             self.transformer_weights.append([q_w, q_b, k_w, k_b, v_w, v_b, attention_output_weight, attention_output_bias,
                                              attention_layer_norm_w, attention_layer_norm_b, intermediate_weight, intermediate_bias,
                                              output_weight, output_bias, ff_layer_norm_w, ff_layer_norm_b])
         #pooler层
-        self.pooler_dense_weight = state_dict["pooler.dense.weight"].numpy()
-        self.pooler_dense_bias = state_dict["pooler.dense.bias"].numpy()
-
+        self.pooler_dense_weight = to_numpy(state_dict["pooler.dense.weight"])
+        self.pooler_dense_bias = to_numpy(state_dict["pooler.dense.bias"])
+
+    #加载fused_state_dict()格式的权重，数组直接使用，不做拼接、转置和复制
+    def load_fused_weights(self, state_dict):
+        self.word_embeddings = state_dict["embeddings.word_embeddings.weight"]
+        self.position_embeddings = state_dict["embeddings.position_embeddings.weight"]
+        self.token_type_embeddings = state_dict["embeddings.token_type_embeddings.weight"]
+        self.embeddings_layer_norm_weight = state_dict["embeddings.LayerNorm.weight"]
+        self.embeddings_layer_norm_bias = state_dict["embeddings.LayerNorm.bias"]
+        self.position_type_embeddings = state_dict["embeddings.position_type"]
+        self.pooler_dense_weight = state_dict["pooler.dense.weight"]
+        self.pooler_dense_bias = state_dict["pooler.dense.bias"]
+        self.transformer_weights = None
+        self.fused_weights = []
+        self.weight_dtype = "float32"
+        for i in range(self.num_layers):
+            layer = []
+            for name in FUSED_WEIGHT_NAMES:
+                key = "fused.layer.%d.%s" % (i, name)
+                if key + ".data" in state_dict:  #低精度存储的线性层权重
+                    data = state_dict[key + ".data"]
+                    self.weight_dtype = "int8" if data.dtype == np.int8 else "float16"
+                    layer.append(LowPrecisionWeight.from_arrays(data, state_dict.get(key + ".scale")))
+                else:
+                    layer.append(state_dict[key])
+            self.fused_weights.append(layer)
+
+    #预处理后的全部权重，{权重名: numpy数组}，用于保存权重文件
+    #低精度的线性层权重拆成name.data和name.scale两个数组（float16没有scale）
+    def fused_state_dict(self):
+        state_dict = {"embeddings.word_embeddings.weight": self.word_embeddings,
+                      "embeddings.position_embeddings.weight": self.position_embeddings,
+                      "embeddings.token_type_embeddings.weight": self.token_type_embeddings,
+                      "embeddings.LayerNorm.weight": self.embeddings_layer_norm_weight,
+                      "embeddings.LayerNorm.bias": self.embeddings_layer_norm_bias,
+                      "embeddings.position_type": self.position_type_embeddings,
+                      "pooler.dense.weight": self.pooler_dense_weight,
+                      "pooler.dense.bias": self.pooler_dense_bias}
+        for i, layer in enumerate(self.fused_weights):
+            for name, weight in zip(FUSED_WEIGHT_NAMES, layer):
+                key = "fused.layer.%d.%s" % (i, name)
+                if isinstance(weight, LowPrecisionWeight):
+                    state_dict[key + ".data"] = weight.data
+                    if weight.scale is not None:
+                        state_dict[key + ".scale"] = weight.scale
+                else:
+                    state_dict[key] = weight
+        return state_dict
+
+    #权重预处理，只在加载时做一次
+    #1. q、k、v三个矩阵拼成一个[hidden_size, 3 * hidden_size]的矩阵，每层的投影只需一次矩阵乘法
+    #2. 所有线性层的权重提前转置并存为C连续数组，避免每次计算时把转置视图(.T)交给BLAS
+    def prepare_weights(self):
+        fused_weights = []
+        for weights in self.transformer_weights:
+            q_w, q_b, \
+            k_w, k_b, \
+            v_w, v_b, \
+            attention_output_weight, attention_output_bias, \
+            attention_layer_norm_w, attention_layer_norm_b, \
+            intermediate_weight, intermediate_bias, \
+            output_weight, output_bias, \
+            ff_layer_norm_w, ff_layer_norm_b = weights
+            qkv_w = np.ascontiguousarray(np.concatenate([q_w, k_w, v_w]).T)  # shape: [hidden_size, 3 * hidden_size]
+            qkv_b = np.concatenate([q_b, k_b, v_b])
+            fused_weights.append([self.convert_weight(qkv_w), qkv_b,
+                                  self.convert_weight(np.ascontiguousarray(attention_output_weight.T)), attention_output_bias,
+                                  attention_layer_norm_w, attention_layer_norm_b,
+                                  self.convert_weight(np.ascontiguousarray(intermediate_weight.T)), intermediate_bias,
+                                  self.convert_weight(np.ascontiguousarray(output_weight.T)), output_bias,
+                                  ff_layer_norm_w, ff_layer_norm_b])
+        return fused_weights
+
+    #按weight_dtype转换线性层权重
+    def convert_weight(self, w_t):
+        if self.weight_dtype == "float32":
+            return w_t
+        return LowPrecisionWeight(w_t, self.weight_dtype)
+
+    #transformer层中线性层权重占用的字节数
+    def linear_weight_bytes(self):
+        weights = self.fused_weights if self.fused_weights is not None else self.transformer_weights
+        return sum(w.nbytes for layer in weights for w in layer if isinstance(w, LowPrecisionWeight) or w.ndim == 2)
+
+    #线性层，w_t为预先转置好的权重[in_size, out_size]
+    #把[batch_size, max_len, in_size]展平成二维，整个batch只做一次矩阵乘法
+    def linear(self, x, w_t, b):
+        x_2d = x.reshape(-1, x.shape[-1])
+        if isinstance(w_t, LowPrecisionWeight):
+            output = w_t.matmul(x_2d) + b
+        else:
+            output = x_2d @ w_t + b
+        return output.reshape(x.shape[:-1] + (w_t.shape[1],))
 
     #bert embedding，使用3层叠加，在经过一个Layer norm层
-    def embedding_forward(self, x):
-        # x.shape = [max_len]
-        we = self.get_embedding(self.word_embeddings, x)  # shpae: [max_len, hidden_size]
-        # position embeding的输入 [0, 1, 2, 3]
-        pe = self.get_embedding(self.position_embeddings, np.array(list(range(len(x)))))  # shpae: [max_len, hidden_size]
-        # token type embedding,单输入的情况下为[0, 0, 0, 0]
-        te = self.get_embedding(self.token_type_embeddings, np.array([0] * len(x)))  # shpae: [max_len, hidden_size]
-        embedding = we + pe + te
+    #start_position为第一个字的位置，增量解码时不为0
+    def embedding_forward(self, x, start_position=0):
+        # x.shape = [batch_size, max_len]
+        embedding = self.get_embedding(self.word_embeddings, x)  # shpae: [batch_size, max_len, hidden_size]
+        # position embedding与token type embedding之和只与位置有关，直接取预先加好的对应行，沿batch维广播
+        embedding += self.position_type_embeddings[start_position:start_position + x.shape[1]]
         # 加和后有一个归一化层
-        embedding = self.layer_norm(embedding, self.embeddings_layer_norm_weight, self.embeddings_layer_norm_bias)  # shpae: [max_len, hidden_size]
+        embedding = self.layer_norm(embedding, self.embeddings_layer_norm_weight, self.embeddings_layer_norm_bias)  # shpae: [batch_size, max_len, hidden_size]
         return embedding
 
     #embedding层实际上相当于按index索引，或理解为onehot输入乘以embedding矩阵
+    #np.take一次取出所有行，结果为新数组，可以在其上原地累加
     def get_embedding(self, embedding_matrix, x):
-        return np.array([embedding_matrix[index] for index in x])
+        return np.take(embedding_matrix, x, axis=0)
 
     #执行全部的transformer层计算
-    def all_transformer_layer_forward(self, x):
+    def all_transformer_layer_forward(self, x, attention_mask=None):
         for i in range(self.num_layers):
-            x = self.single_transformer_layer_forward(x, i)
+            x = self.single_transformer_layer_forward(x, i, attention_mask)
         return x
 
     #执行单层transformer层计算
-    def single_transformer_layer_forward(self, x, layer_index):
+    def single_transformer_layer_forward(self, x, layer_index, attention_mask=None):
+        if self.fused_weights is not None:
+            return self.fused_transformer_layer_forward(x, layer_index, attention_mask)
         weights = self.transformer_weights[layer_index]
         #取出该层的参数，在实际中，这些参数都是随机初始化，之后进行预训练
         q_w, q_b, \
@@ -113,7 +347,8 @@ class DiyBert:
                                 v_w, v_b,
                                 attention_output_weight, attention_output_bias,
                                 self.num_attention_heads,
-                                self.hidden_size)
+                                self.hidden_size,
+                                attention_mask)
         #bn层，并使用了残差机制
         x = self.layer_norm(x + attention_output, attention_layer_norm_w, attention_layer_norm_b)
         #feed forward层
@@ -124,6 +359,33 @@ class DiyBert:
         x = self.layer_norm(x + feed_forward_x, ff_layer_norm_w, ff_layer_norm_b)
         return x
 
+    #使用预处理后权重的单层transformer计算，结果与single_transformer_layer_forward相同
+    #传入cache时为增量解码，x只包含新位置，见decode_step
+    def fused_transformer_layer_forward(self, x, layer_index, attention_mask=None, cache=None):
+        qkv_w, qkv_b, \
+        attention_output_weight_t, attention_output_bias, \
+        attention_layer_norm_w, attention_layer_norm_b, \
+        intermediate_weight_t, intermediate_bias, \
+        output_weight_t, output_bias, \
+        ff_layer_norm_w, ff_layer_norm_b = self.fused_weights[layer_index]
+        #q、k、v一次矩阵乘法得到，再按最后一维切成三份
+        q, k, v = np.split(self.linear(x, qkv_w, qkv_b), 3, axis=-1)
+        if cache is not None:
+            #把新位置的k、v写入缓存，再取出到目前为止所有位置的k、v参与计算
+            start = cache["length"]
+            end = start + x.shape[1]
+            cache["keys"][layer_index][:, start:end] = k
+            cache["values"][layer_index][:, start:end] = v
+            k = cache["keys"][layer_index][:, :end]
+            v = cache["values"][layer_index][:, :end]
+        qkv = self.multi_head_attention(q, k, v, self.num_attention_heads, self.hidden_size, attention_mask)
+        attention_output = self.linear(qkv, attention_output_weight_t, attention_output_bias)
+        x = self.layer_norm(x + attention_output, attention_layer_norm_w, attention_layer_norm_b)
+        feed_forward_x = gelu(self.linear(x, intermediate_weight_t, intermediate_bias))
+        feed_forward_x = self.linear(feed_forward_x, output_weight_t, output_bias)
+        x = self.layer_norm(x + feed_forward_x, ff_layer_norm_w, ff_layer_norm_b)
+        return x
+
     # self attention的计算
     def self_attention(self,
                        x,
@@ -136,38 +398,68 @@ class DiyBert:
                        attention_output_weight,
                        attention_output_bias,
                        num_attention_heads,
-                       hidden_size):
-        # x.shape = max_len * hidden_size
+                       hidden_size,
+                       attention_mask=None):
+        # x.shape = batch_size * max_len * hidden_size
+        # attention_mask.shape = batch_size * max_len，1为真实token，0为padding
+        # 也可以是batch_size * max_len * max_len，为每个位置单独指定能看到哪些位置（如从左到右的语言模型）
         # q_w, k_w, v_w  shape = hidden_size * hidden_size
         # q_b, k_b, v_b  shape = hidden_size
-        q = np.dot(x, q_w.T) + q_b  # shape: [max_len, hidden_size]      W * X + B lINER
-        k = np.dot(x, k_w.T) + k_b  # shpae: [max_len, hidden_size]
-        v = np.dot(x, v_w.T) + v_b  # shpae: [max_len, hidden_size]
+        q = np.dot(x, q_w.T) + q_b  # shape: [batch_size, max_len, hidden_size]      W * X + B lINER
+        k = np.dot(x, k_w.T) + k_b  # shpae: [batch_size, max_len, hidden_size]
+        v = np.dot(x, v_w.T) + v_b  # shpae: [batch_size, max_len, hidden_size]
+        qkv = self.multi_head_attention(q, k, v, num_attention_heads, hidden_size, attention_mask)
+        # attention.shape = batch_size, max_len, hidden_size
+        attention = np.dot(qkv, attention_output_weight.T) + attention_output_bias
+        return attention
+
+    #多头注意力，输入q、k、v的shape均为[batch_size, max_len, hidden_size]
+    def multi_head_attention(self, q, k, v, num_attention_heads, hidden_size, attention_mask=None):
         attention_head_size = int(hidden_size / num_attention_heads)
-        # q.shape = num_attention_heads, max_len, attention_head_size
+        # q.shape = batch_size, num_attention_heads, max_len, attention_head_size
         q = self.transpose_for_scores(q, attention_head_size, num_attention_heads)
-        # k.shape = num_attention_heads, max_len, attention_head_size
+        # k.shape = batch_size, num_attention_heads, max_len, attention_head_size
         k = self.transpose_for_scores(k, attention_head_size, num_attention_heads)
-        # v.shape = num_attention_heads, max_len, attention_head_size
+        # v.shape = batch_size, num_attention_heads, max_len, attention_head_size
         v = self.transpose_for_scores(v, attention_head_size, num_attention_heads)
-        # qk.shape = num_attention_heads, max_len, max_len
-        qk = np.matmul(q, k.swapaxes(1, 2))  
+        if attention_mask is not None and attention_mask.ndim == 2:
+            attention_mask = attention_mask[:, None, :]
+        if self.executor is not None and self.parallel_mode == "heads":
+            #每组是连续的若干个头，各组的结果直接写入qkv的对应位置
+            qkv = np.empty(q.shape, dtype=q.dtype)
+            groups = [slice(heads[0], heads[-1] + 1) for heads in
+                      np.array_split(np.arange(num_attention_heads), min(self.num_workers, num_attention_heads))]
+            list(self.executor.map(lambda heads: self.attention_heads(q, k, v, attention_mask, heads, qkv), groups))
+        else:
+            qkv = self.attention_heads(q, k, v, attention_mask)
+        # qkv.shape = batch_size, max_len, hidden_size
+        qkv = qkv.swapaxes(1, 2).reshape(q.shape[0], -1, hidden_size)
+        return qkv
+
+    #计算部分注意力头，heads为这些头的切片，为None时计算所有头
+    #传入output时结果写入output[:, heads]，否则返回新数组
+    def attention_heads(self, q, k, v, attention_mask=None, heads=None, output=None):
+        if heads is not None:
+            q, k, v = q[:, heads], k[:, heads], v[:, heads]
+        attention_head_size = q.shape[-1]
+        # qk.shape = batch_size, num_attention_heads, max_len, max_len
+        qk = np.matmul(q, k.swapaxes(-1, -2))
         qk /= np.sqrt(attention_head_size)
+        # padding位置加上一个很大的负数，softmax之后权重接近0，与torch版BertModel的做法一致
+        if attention_mask is not None:
+            qk += (1.0 - attention_mask[:, None, :, :]) * -10000.0
         qk = softmax(qk)
-        # qkv.shape = num_attention_heads, max_len, attention_head_size
-        qkv = np.matmul(qk, v)
-        # qkv.shape = max_len, hidden_size
-        qkv = qkv.swapaxes(0, 1).reshape(-1, hidden_size)
-        # attention.shape = max_len, hidden_size
-        attention = np.dot(qkv, attention_output_weight.T) + attention_output_bias
-        return attention
+        # qkv.shape = batch_size, num_attention_heads, max_len, attention_head_size
+        if output is None:
+            return np.matmul(qk, v)
+        output[:, heads] = np.matmul(qk, v)
 
     #多头机制
     def transpose_for_scores(self, x, attention_head_size, num_attention_heads):
         # hidden_size = 768  num_attent_heads = 12 attention_head_size = 64
-        max_len, hidden_size = x.shape
-        x = x.reshape(max_len, num_attention_heads, attention_head_size)
-        x = x.swapaxes(1, 0)  # output shape = [num_attention_heads, max_len, attention_head_size]
+        batch_size, max_len, hidden_size = x.shape
+        x = x.reshape(batch_size, max_len, num_attention_heads, attention_head_size)
+        x = x.swapaxes(1, 2)  # output shape = [batch_size, num_attention_heads, max_len, attention_head_size]
         return x
 
     #前馈网络的计算
@@ -178,17 +470,22 @@ class DiyBert:
                      output_weight,  # hidden_size, intermediate_size
                      output_bias,  # hidden_size
                      ):
-        # output shpae: [max_len, intermediate_size]
+        # output shpae: [batch_size, max_len, intermediate_size]
         x = np.dot(x, intermediate_weight.T) + intermediate_bias
         x = gelu(x)
-        # output shpae: [max_len, hidden_size]
+        # output shpae: [batch_size, max_len, hidden_size]
         x = np.dot(x, output_weight.T) + output_bias
         return x
 
     #归一化层
+    #x会被原地修改，调用处传入的都是残差相加等临时结果，不需要再分配同样大小的中间数组
+    #方差由减去均值后的x自身点积得到，与np.std相同（除以n）
     def layer_norm(self, x, w, b):
-        x = (x - np.mean(x, axis=1, keepdims=True)) / np.std(x, axis=1, keepdims=True)
-        x = x * w + b
+        x -= np.mean(x, axis=-1, keepdims=True)
+        variance = np.einsum("...i,...i->...", x, x) / x.shape[-1]
+        x /= np.sqrt(variance)[..., None]
+        x *= w
+        x += b
         return x
 
     #链接[cls] token的输出层
@@ -198,24 +495,151 @@ class DiyBert:
         return x
 
     #最终输出
-    def forward(self, x):
+    #x可以是单个句子[max_len]，也可以是一个batch[batch_size, max_len]
+    #attention_mask与x形状相同，1为真实token，0为padding，不传时认为全部是真实token
+    #causal=True时每个位置只能看到自己和之前的位置，与decode_step逐字计算的结果一致
+    def forward(self, x, attention_mask=None, causal=False):
+        x = np.asarray(x)
+        single = x.ndim == 1
+        if single:
+            x = x[None, :]
+        if attention_mask is not None:
+            attention_mask = np.asarray(attention_mask, dtype=np.float32).reshape(x.shape)
+        if causal:
+            if attention_mask is None:
+                attention_mask = np.ones(x.shape, dtype=np.float32)
+            attention_mask = attention_mask[:, None, :] * np.tril(np.ones((x.shape[1], x.shape[1]), dtype=np.float32))
+        if self.executor is not None and self.parallel_mode == "batch" and x.shape[0] > 1:
+            sequence_output, pooler_output = self.parallel_encode(x, attention_mask)
+        else:
+            sequence_output, pooler_output = self.encode(x, attention_mask)
+        if single:
+            return sequence_output[0], pooler_output[0]
+        return sequence_output, pooler_output
+
+    #x.shape = [batch_size, max_len]，返回(sequence_output, pooler_output)
+    def encode(self, x, attention_mask=None):
         x = self.embedding_forward(x)
-        sequence_output = self.all_transformer_layer_forward(x)
-        pooler_output = self.pooler_output_layer(sequence_output[0])
+        sequence_output = self.all_transformer_layer_forward(x, attention_mask)
+        pooler_output = self.pooler_output_layer(sequence_output[:, 0])
         return sequence_output, pooler_output
 
+    #batch按行分成num_workers份，各自在一个线程中计算encode，再按原顺序拼接
+    def parallel_encode(self, x, attention_mask=None):
+        chunks = np.array_split(np.arange(x.shape[0]), min(self.num_workers, x.shape[0]))
+        results = list(self.executor.map(lambda rows: self.encode(x[rows], None if attention_mask is None else attention_mask[rows]), chunks))
+        return np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results])
+
+    #增量解码，用于从左到右逐字打分或生成（如week10中用bert做语言模型）
+    #缓存每一层已经算过的k、v，新位置只计算自己的投影，再与缓存中的所有位置做注意力
+    #每生成一个字的计算量为O(L)，而不是每次重新计算整句的O(L^2)
+    #缓存按最大长度预先分配，shape: [batch_size, max_len, hidden_size]
+    def init_cache(self, batch_size=1, max_len=None):
+        max_len = max_len or self.position_embeddings.shape[0]
+        shape = (batch_size, max_len, self.hidden_size)
+        dtype = self.word_embeddings.dtype
+        return {"keys": [np.zeros(shape, dtype=dtype) for _ in range(self.num_layers)],
+                "values": [np.zeros(shape, dtype=dtype) for _ in range(self.num_layers)],
+                "length": 0}
+
+    #x为新输入的字，shape: [batch_size]或[batch_size, 新字数]
+    #返回新位置的输出，shape: [batch_size, 新字数, hidden_size]
+    def decode_step(self, x, cache):
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x[:, None]
+        if self.fused_weights is None:
+            self.fused_weights = self.prepare_weights()
+        start = cache["length"]
+        end = start + x.shape[1]
+        if end > cache["keys"][0].shape[1]:
+            raise ValueError("超出缓存的最大长度：%d" % cache["keys"][0].shape[1])
+        #新位置可以看到之前的所有位置，新位置之间只能看到自己和之前的位置
+        attention_mask = np.tril(np.ones((x.shape[1], end), dtype=np.float32), k=start)
+        attention_mask = np.broadcast_to(attention_mask, (x.shape[0],) + attention_mask.shape)
+        x = self.embedding_forward(x, start)
+        for i in range(self.num_layers):
+            x = self.fused_transformer_layer_forward(x, i, attention_mask, cache)
+        cache["length"] = end
+        return x
 
-#自制
-db = DiyBert(state_dict)
-diy_sequence_output, diy_pooler_output = db.forward(x)
-#torch
-torch_sequence_output, torch_pooler_output = bert(torch_x)
 
-print('diy_sequence_output is:\n', diy_sequence_output)
-print('torch_sequence_output is:\n', torch_sequence_output)
+#对比两种权重布局的速度：原始布局每层做q、k、v三次带转置的矩阵乘法，预处理后只做一次
+def benchmark_weight_layout(state_dict, x, attention_mask=None, repeat=10):
+    cost = {}
+    outputs = {}
+    for fuse_weights in [False, True]:
+        model = DiyBert(state_dict, fuse_weights)
+        model.forward(x, attention_mask)  #预热
+        start_time = time.time()
+        for _ in range(repeat):
+            outputs[fuse_weights] = model.forward(x, attention_mask)[0]
+        cost[fuse_weights] = (time.time() - start_time) / repeat
+    print("原始权重布局：%.4f秒/次，预处理后：%.4f秒/次，加速%.2f倍，最大误差：%e" %
+          (cost[False], cost[True], cost[False] / cost[True], np.max(np.abs(outputs[False] - outputs[True]))))
+    return cost
+
+
+#embedding层的耗时：逐字python循环取向量、分开计算均值和标准差的原实现与向量化实现对比，以及占整个forward的比例
+def benchmark_embedding(model, x, repeat=100):
+    def loop_embedding(x):
+        we = np.array([[model.word_embeddings[index] for index in row] for row in x])
+        pe = np.array([model.position_embeddings[index] for index in range(x.shape[1])])
+        te = np.array([model.token_type_embeddings[index] for index in [0] * x.shape[1]])
+        embedding = we + pe + te
+        embedding = (embedding - np.mean(embedding, axis=-1, keepdims=True)) / np.std(embedding, axis=-1, keepdims=True)
+        return embedding * model.embeddings_layer_norm_weight + model.embeddings_layer_norm_bias
+    cost = {}
+    for name, func in [("python循环", loop_embedding), ("向量化", model.embedding_forward), ("整个forward", model.forward)]:
+        func(x)  #预热
+        start_time = time.time()
+        for _ in range(repeat):
+            func(x)
+        cost[name] = (time.time() - start_time) / repeat
+    print("embedding层 python循环：%.6f秒/次，向量化：%.6f秒/次，加速%.1f倍，占整个forward的%.2f%%，最大误差：%e" %
+          (cost["python循环"], cost["向量化"], cost["python循环"] / cost["向量化"], cost["向量化"] / cost["整个forward"] * 100,
+           np.max(np.abs(loop_embedding(x) - model.embedding_forward(x)))))
+    return cost
+
+
+#线程数从1到max_workers的加速比，两种并行方式分别测试
+def benchmark_workers(state_dict, x, max_workers=None, repeat=5):
+    max_workers = max_workers or os.cpu_count()
+    report = {}
+    for parallel_mode in ["batch", "heads"]:
+        base_cost = None
+        base_output = None
+        report[parallel_mode] = {}
+        for num_workers in range(1, max_workers + 1):
+            model = DiyBert(state_dict, num_workers=num_workers, parallel_mode=parallel_mode)
+            output = model.forward(x)[0]  #预热
+            start_time = time.time()
+            for _ in range(repeat):
+                model.forward(x)
+            cost = (time.time() - start_time) / repeat
+            if base_cost is None:
+                base_cost, base_output = cost, output
+            report[parallel_mode][num_workers] = cost
+            print("%s并行 %d线程：%.4f秒/次，加速%.2f倍，最大误差：%e" %
+                  (parallel_mode, num_workers, cost, base_cost / cost, np.max(np.abs(output - base_output))))
+            if model.executor is not None:
+                model.executor.shutdown()
+    return report
+
+
+#不同权重精度与torch输出的误差，以及线性层权重内存和耗时的对比
+def compare_weight_dtype(state_dict, x, torch_output, repeat=10):
+    for weight_dtype in ["float32", "float16", "int8"]:
+        model = DiyBert(state_dict, weight_dtype=weight_dtype)
+        output, _ = model.forward(x)
+        start_time = time.time()
+        for _ in range(repeat):
+            model.forward(x)
+        cost = (time.time() - start_time) / repeat
+        cosine = np.sum(output * torch_output, axis=-1) / (np.linalg.norm(output, axis=-1) * np.linalg.norm(torch_output, axis=-1))
+        print("%s：线性层权重%.1fMB，%.4f秒/次，与torch最大误差：%e，平均余弦相似度：%.6f" %
+              (weight_dtype, model.linear_weight_bytes() / 1024 ** 2, cost, np.max(np.abs(output - torch_output)), np.mean(cosine)))
 
-# print(diy_pooler_output)
-# print(torch_pooler_output)
 
 # 计算bert模型总参数量
 def count_bert_parameters(state_dict, num_layers):
@@ -266,7 +690,69 @@ def count_bert_parameters(state_dict, num_layers):
     return total_params
 
 
-num_layers = 1  # 此处与config.json中的num_hidden_layers保持一致
-total_params = count_bert_parameters(bert.state_dict(), num_layers)
-print(f"\nBERT模型层数:{num_layers}, 总参数量为: {total_params}")
-
+if __name__ == "__main__":
+    import torch
+    from transformers import BertModel
+
+    bert = BertModel.from_pretrained(r"D:\八斗NLP课件\week06 语言模型和预训练\bert-base-chinese", return_dict=False)
+    state_dict = bert.state_dict()
+    bert.eval()
+    x = np.array([2450, 15486, 102, 2110])   #假想成4个字的句子
+    torch_x = torch.LongTensor([x])          #pytorch形式输入
+    seqence_output, pooler_output = bert(torch_x)
+    print(seqence_output.shape, pooler_output.shape)
+    # print(seqence_output, pooler_output)
+
+    print(bert.state_dict().keys())  #查看所有的权值矩阵名称
+
+    #自制
+    num_attention_heads = bert.config.num_attention_heads
+    db = DiyBert(state_dict, num_attention_heads=num_attention_heads)
+    diy_sequence_output, diy_pooler_output = db.forward(x)
+    #torch
+    torch_sequence_output, torch_pooler_output = bert(torch_x)
+
+    print('diy_sequence_output is:\n', diy_sequence_output)
+    print('torch_sequence_output is:\n', torch_sequence_output)
+
+    # print(diy_pooler_output)
+    # print(torch_pooler_output)
+
+    #batch输入：不同长度的句子补齐到相同长度，padding位置在attention_mask中标为0
+    batch_x = np.array([[2450, 15486, 102, 2110], [2450, 15486, 0, 0]])
+    batch_mask = np.array([[1, 1, 1, 1], [1, 1, 0, 0]])
+    diy_batch_output, diy_batch_pooler = db.forward(batch_x, batch_mask)
+    torch_batch_output, torch_batch_pooler = bert(torch.LongTensor(batch_x), attention_mask=torch.LongTensor(batch_mask))
+    print('batch最大误差：', np.max(np.abs(diy_batch_output - torch_batch_output.detach().numpy())[batch_mask == 1]))
+
+    benchmark_weight_layout(state_dict, np.random.randint(0, 21128, size=(8, 32)), repeat=3)
+
+    benchmark_workers(state_dict, np.random.randint(0, 21128, size=(8, 32)), repeat=3)
+
+    benchmark_embedding(db, np.random.randint(0, 21128, size=(8, 32)), repeat=10)
+
+    compare_weight_dtype(state_dict, x, torch_sequence_output.detach().numpy()[0])
+
+    #增量解码：逐字输入，结果与causal=True的整句计算一致
+    cache = db.init_cache()
+    incremental_output = np.concatenate([db.decode_step(np.array([token]), cache) for token in x], axis=1)[0]
+    causal_output, _ = db.forward(x, causal=True)
+    print('增量解码最大误差：', np.max(np.abs(incremental_output - causal_output)))
+
+    #转换为权重文件，之后的推理只需要numpy
+    save_weight_file(state_dict, "bert_weights.bin", num_attention_heads=num_attention_heads)
+    start_time = time.time()
+    mmap_db = DiyBert.from_weight_file("bert_weights.bin")
+    print('从权重文件加载耗时：%.2f毫秒' % ((time.time() - start_time) * 1000))
+    mmap_sequence_output, _ = mmap_db.forward(x)
+    print('权重文件加载与state_dict加载最大误差：', np.max(np.abs(mmap_sequence_output - diy_sequence_output)))
+    #int8量化后的权重同样可以直接保存和加载
+    save_weight_file(state_dict, "bert_weights_int8.bin", weight_dtype="int8", num_attention_heads=num_attention_heads)
+    start_time = time.time()
+    int8_db = DiyBert.from_weight_file("bert_weights_int8.bin")
+    print('从int8权重文件加载耗时：%.2f毫秒，与float32最大误差：%e' %
+          ((time.time() - start_time) * 1000, np.max(np.abs(int8_db.forward(x)[0] - diy_sequence_output))))
+
+    num_layers = db.num_layers  # 与config.json中的num_hidden_layers一致
+    total_params = count_bert_parameters(bert.state_dict(), num_layers)
+    print(f"\nBERT模型层数:{num_layers}, 总参数量为: {total_params}")